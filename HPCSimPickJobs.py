@@ -1,17 +1,24 @@
 from job import Job, Workloads
-from cluster import Cluster
+from cluster import make_cluster, cluster_key
+from baseline_cache import BaselineCache
 
 import os
 import math
 import json
 import time
 import sys
+import copy
 import random
-from random import shuffle
+import heapq
+import bisect
 
 import numpy as np
-import tensorflow as tf
 import scipy.signal
+try:
+    import tensorflow as tf
+except ImportError:
+    # only the policy helpers (placeholder, get_vars, ...) need TensorFlow, the simulator runs without it.
+    tf = None
 
 import gym
 from gym import spaces
@@ -31,6 +38,12 @@ DEBUG = False
 JOB_SEQUENCE_SIZE = 256
 SKIP_TIME = 360 # skip 60 seconds
 
+# the attributes of an HPCEnv that, with its queues, its cluster and the jobs of its window, make up the state of
+# the sequence being simulated. See HPCEnv.snapshot.
+SNAPSHOT_ATTRS = ["current_timestamp", "start", "start_idx_last_reset", "next_arriving_job_idx", "last_job_in_batch",
+                  "num_job_in_batch", "window_start", "window_jobs", "penalty", "pivot_job", "scheduled_rl", "scheduled_scores",
+                  "pre_workloads", "visible_jobs", "action_mask"]
+
 def combined_shape(length, shape=None):
     if shape is None:
         return (length,)
@@ -63,8 +76,266 @@ def discount_cumsum(x, discount):
     return scipy.signal.lfilter([1], [1, float(-discount)], x[::-1], axis=0)[::-1]
 
 
+# heuristic scores of many jobs at once, from arrays of their submit time, request time, requested processors and
+# waiting time (scheduled_time - submit_time). Lower is better. HPCEnv.f1_score, ... are the same on one job.
+def f1_scores(submit_time, request_time, request_processors, waiting_time):
+    # f1: log10(r)*n + 870*log10(s)
+    return (np.log10(np.where(request_time > 0, request_time, 0.1)) * request_processors +
+            870 * np.log10(np.where(submit_time > 0, submit_time, 0.1)))
+
+
+def f2_scores(submit_time, request_time, request_processors, waiting_time):
+    # f2: r^(1/2)*n + 25600 * log10(s)
+    return np.sqrt(request_time) * request_processors + 25600 * np.log10(submit_time)
+
+
+def f3_scores(submit_time, request_time, request_processors, waiting_time):
+    # f3: r * n + 6860000 * log10(s)
+    return request_time * request_processors + 6860000 * np.log10(submit_time)
+
+
+def f4_scores(submit_time, request_time, request_processors, waiting_time):
+    # f4: r * sqrt(n) + 530000 * log10(s)
+    return request_time * np.sqrt(request_processors) + 530000 * np.log10(submit_time)
+
+
+def wfp_scores(submit_time, request_time, request_processors, waiting_time):
+    return -np.power(np.true_divide(waiting_time, request_time), 3) * request_processors
+
+
+def uni_scores(submit_time, request_time, request_processors, waiting_time):
+    return -(waiting_time + 1e-15) / (np.log2(request_processors + 1e-15) * request_time)
+
+
+BATCH_SCORES = {"f1_score": f1_scores, "f2_score": f2_scores, "f3_score": f3_scores, "f4_score": f4_scores,
+                "wfp_score": wfp_scores, "uni_score": uni_scores}
+
+
+def shuffle_draws(n):
+    # the draws random.shuffle makes from the random module's stream to shuffle a list of n items, without the
+    # list: for i from n down to 2, getrandbits(i.bit_length()) until one is below i (see Random._randbelow)
+    getrandbits = random.getrandbits
+    for i in range(n, 1, -1):
+        k = i.bit_length()
+        while getrandbits(k) >= i:
+            pass
+
+
+class RunningJobs:
+    """
+    Running jobs kept in a binary heap keyed on their actual finish time (scheduled_time + run_time),
+    so the next release event is found in O(log n) instead of sorting the whole list every time.
+    Jobs finishing at the same time are released in the order they started.
+
+    They also form the resource profile backfilling reserves nodes on: the estimated finish times
+    (scheduled_time + request_time) of the running jobs, kept sorted as they start and finish, with the
+    number of nodes each of them releases. The running totals of released nodes are only rebuilt on the
+    first reservation after a change, and a reservation is then a binary search on them.
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = 0
+        self.profile_keys = []      # (estimated finish time, counter), sorted
+        self.profile_nodes = []     # nodes released at profile_keys[i]
+        self.released = None        # running totals of profile_nodes, None when out of date
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return (entry[2] for entry in self.heap)
+
+    def push(self, job):
+        heapq.heappush(self.heap, (job.scheduled_time + job.run_time, self.counter, job))
+        key = (job.scheduled_time + job.request_time, self.counter)
+        i = bisect.bisect_left(self.profile_keys, key)
+        self.profile_keys.insert(i, key)
+        self.profile_nodes.insert(i, len(job.allocated_machines))
+        self.released = None
+        self.counter += 1
+
+    def peek(self):
+        return self.heap[0][2]
+
+    def pop(self):
+        _, counter, job = heapq.heappop(self.heap)
+        i = bisect.bisect_left(self.profile_keys, (job.scheduled_time + job.request_time, counter))
+        del self.profile_keys[i]
+        del self.profile_nodes[i]
+        self.released = None
+        return job
+
+    def copy(self):
+        running = copy.copy(self)
+        running.heap, running.profile_keys, running.profile_nodes = \
+            list(self.heap), list(self.profile_keys), list(self.profile_nodes)
+        return running
+
+    def earliest_start(self, free_nodes, request_nodes):
+        # the estimated time request_nodes nodes are free, i.e. the first estimated finish time by which enough
+        # nodes are released (the last one if they never are); None if nothing is running
+        if not self.profile_keys:
+            return None
+        if self.released is None:
+            self.released = np.cumsum(self.profile_nodes)
+        i = min(np.searchsorted(self.released, request_nodes - free_nodes), len(self.profile_keys) - 1)
+        return self.profile_keys[i][0]
+
+
+class JobQueue:
+    """
+    The wait queue. Jobs are kept in arrival order in a dict keyed by job id, so removing one is O(1) instead of
+    a scan of a list. Backfilling walks the queue in FCFS order (submit time, then arrival): the keys of that
+    order are kept sorted as jobs arrive, and the ones of removed jobs are left as tombstones, skipped on the way
+    and dropped once they outnumber the waiting jobs.
+
+    The heuristic schedulers pick the job with the lowest score_fn(job), see order_by. The score of a waiting job
+    never changes (they all only read what the job was submitted with; the waiting time of wfp_score and
+    uni_score is taken from scheduled_time, which stays -1 until the job starts), so it is computed once on arrival
+    and the jobs are kept in a binary heap on (score, arrival counter): a pick is O(log n) instead of a scan of
+    the whole queue, with the same ties. Removed jobs are dropped lazily from the top of the heap.
+
+    The observation shows the first jobs of the queue in FCFS, SJF and smallest-first orders, ties broken by the
+    position of the jobs in a queue the old observation sorted in place (see observe_by and sort_smallest_first).
+    The three orders are kept sorted as jobs arrive and leave, so an observation reads the first MAX_QUEUE_SIZE
+    jobs of each instead of sorting the whole queue. The jobs that arrive are only sorted in on the next
+    observation: the heuristic schedules, which never observe the queue, do not pay for them.
+    """
+    def __init__(self):
+        self.jobs = {}
+        self.fcfs_keys = []     # sorted (submit time, arrival counter, job id)
+        self.counter = 0
+        self.num_tombstones = 0
+        self.score_fn = None
+        self.heap = []          # (score_fn(job), arrival counter, job id), when ordered by a score_fn
+        self.keys = None        # {order: rank of every job of the window}, when observed
+        self.offset = 0         # trace index of rank 0 in self.keys
+        self.orders = {}        # {order: sorted (rank, queue position, job id)}, see position
+        self.entries = {}       # job id -> its entry in each of self.orders
+        self.arrived = []       # (arrival counter, job) not sorted into self.orders yet
+        self.unsorted = []      # (arrival counter, job) in self.orders that came after the last smallest-first sort
+        self.sorted_before = 0  # arrival counter of the first job that came after the last smallest-first sort
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __iter__(self):
+        return iter(self.jobs.values())
+
+    def append(self, job):
+        self.jobs[job.job_id] = job
+        if self.score_fn is not None:
+            heapq.heappush(self.heap, (self.score_fn(job), self.counter, job.job_id))
+        if self.keys is not None:
+            self.arrived.append((self.counter, job))
+        key = (job.submit_time, self.counter, job.job_id)
+        self.counter += 1
+        if not self.fcfs_keys or key > self.fcfs_keys[-1]:
+            self.fcfs_keys.append(key)
+        else:
+            bisect.insort(self.fcfs_keys, key)
+
+    def remove(self, job):
+        del self.jobs[job.job_id]
+        self.remove_entries(job)
+        self.num_tombstones += 1
+        if self.num_tombstones > len(self.jobs):
+            self.fcfs_keys = [key for key in self.fcfs_keys if key[2] in self.jobs]
+            self.heap = [entry for entry in self.heap if entry[2] in self.jobs]
+            heapq.heapify(self.heap)
+            self.arrived = [(counter, job) for counter, job in self.arrived if job.job_id in self.jobs]
+            self.num_tombstones = 0
+
+    def fcfs_order(self):
+        # the waiting jobs in FCFS order, found as they are iterated (jobs removed on the way, e.g. backfilled, are
+        # skipped), so a pass of backfilling does not build a list of the whole queue first
+        jobs = self.jobs
+        for key in self.fcfs_keys:
+            job = jobs.get(key[2])
+            if job is not None:
+                yield job
+
+    def observe_by(self, keys, offset):
+        # keep the waiting jobs, and the ones arriving from now on, in the orders of keys ({order: rank of every job
+        # of the window, by trace index - offset}, "smallest" among them), ties broken by queue position
+        self.keys = {name: key.tolist() for name, key in keys.items()}
+        self.offset = offset
+        self.orders = {name: [] for name in keys}
+        self.entries = {}
+        self.unsorted = []
+        self.arrived = [(key[1], self.jobs[key[2]]) for key in self.fcfs_keys if key[2] in self.jobs]
+
+    def position(self, counter, job):
+        # the position of a job in the queue the old observation sorted in place: appended on arrival, and sorted
+        # smallest first with the queue when that was longer than MAX_QUEUE_SIZE. The sort was stable, and its key
+        # set jobs apart unless they were alike in all the keys of the observation, so it left the jobs that were
+        # waiting then by (smallest key, arrival), before the ones that came after, by arrival.
+        if counter < self.sorted_before:
+            return 0, self.keys["smallest"][job.trace_idx - self.offset], counter
+        return 1, 0, counter
+
+    def sort_in(self, counter, job):
+        i = job.trace_idx - self.offset
+        position = self.position(counter, job)
+        entries = {name: (key[i],) + position + (job.job_id,) for name, key in self.keys.items()}
+        for name, entry in entries.items():
+            bisect.insort(self.orders[name], entry)
+        self.entries[job.job_id] = entries
+        if counter >= self.sorted_before:
+            self.unsorted.append((counter, job))
+
+    def remove_entries(self, job):
+        entries = self.entries.pop(job.job_id, None)
+        if entries is not None:
+            for name, entry in entries.items():
+                order = self.orders[name]
+                del order[bisect.bisect_left(order, entry)]
+
+    def sort_arrived(self):
+        for counter, job in self.arrived:
+            if job.job_id in self.jobs:
+                self.sort_in(counter, job)
+        self.arrived = []
+
+    def first(self, name, count):
+        # the first count waiting jobs in an order of observe_by
+        self.sort_arrived()
+        return [self.jobs[entry[-1]] for entry in self.orders[name][:count]]
+
+    def sort_smallest_first(self):
+        # what the old observation did to a queue longer than MAX_QUEUE_SIZE, see position: only the jobs that came
+        # since the last time move, each once
+        self.sort_arrived()
+        unsorted, self.unsorted = self.unsorted, []
+        self.sorted_before = self.counter
+        for counter, job in unsorted:
+            if job.job_id in self.entries:
+                self.remove_entries(job)
+                self.sort_in(counter, job)
+
+    def order_by(self, score_fn):
+        # keep the waiting jobs, and the ones arriving from now on, in a heap on score_fn
+        self.score_fn = score_fn
+        self.heap = [(score_fn(self.jobs[key[2]]), key[1], key[2]) for key in self.fcfs_keys if key[2] in self.jobs]
+        heapq.heapify(self.heap)
+
+    def best(self):
+        # the waiting job with the lowest score (the earliest arrival among ties), see order_by
+        while self.heap[0][2] not in self.jobs:
+            heapq.heappop(self.heap)
+        return self.jobs[self.heap[0][2]]
+
+    def copy(self):
+        queue = copy.copy(self)
+        queue.jobs, queue.fcfs_keys, queue.heap = dict(self.jobs), list(self.fcfs_keys), list(self.heap)
+        queue.orders = {name: list(order) for name, order in self.orders.items()}
+        queue.entries, queue.arrived, queue.unsorted = dict(self.entries), list(self.arrived), list(self.unsorted)
+        return queue
+
+
 class HPCEnv(gym.Env):
-    def __init__(self,shuffle=False, backfil=False, skip=False, job_score_type=0, batch_job_slice=0, build_sjf=False):  # do nothing and return. A workaround for passing parameters to the environment
+    def __init__(self,shuffle=False, backfil=False, skip=False, job_score_type=0, batch_job_slice=0, build_sjf=False,
+                 baseline_cache=True, cluster="simple", cluster_policy="first_fit"):  # do nothing and return. A workaround for passing parameters to the environment
         super(HPCEnv, self).__init__()
         print("Initialize Simple HPC Env")
 
@@ -73,10 +344,13 @@ class HPCEnv(gym.Env):
                                             shape=(JOB_FEATURES * MAX_QUEUE_SIZE,),
                                             dtype=np.float32)
 
-        self.job_queue = []
-        self.running_jobs = []
+        self.job_queue = JobQueue()
+        self.running_jobs = RunningJobs()
         self.visible_jobs = []
-        self.pairs = []
+        self.action_mask = None
+        self.window_start = 0
+        # this environment's own Job objects of the current sequence, by trace index, see job
+        self.window_jobs = {}
 
         self.current_timestamp = 0
         self.start = 0
@@ -107,97 +381,52 @@ class HPCEnv(gym.Env):
         self.build_sjf = build_sjf
         self.sjf_scores = []
 
+        # the cluster model and, for the "node" one, its allocation policy (see cluster.make_cluster)
+        self.cluster_model = cluster
+        self.cluster_policy = cluster_policy
+
+        # heuristic scores of the sampled sequences, memoized on disk next to the workload (see baseline_score)
+        self.use_baseline_cache = baseline_cache
+        self.baselines = None
+
     #@profile
     def my_init(self, workload_file = '', sched_file = ''):
         print ("loading workloads from dataset:", workload_file)
         self.loads = Workloads(workload_file)
-        self.cluster = Cluster("Cluster", self.loads.max_nodes, self.loads.max_procs/self.loads.max_nodes)
+        self.cluster = make_cluster(self.cluster_model, self.loads.max_nodes, self.loads.max_procs/self.loads.max_nodes,
+                                    self.cluster_policy)
         self.penalty_job_score = JOB_SEQUENCE_SIZE * self.loads.max_exec_time / 10
+        if self.use_baseline_cache:
+            self.baselines = BaselineCache(workload_file + ".baselines.sqlite", self.loads.digest)
 
         if self.build_sjf: #this is for trajectory filtering.
-            #calculate SJF scores for all sample sequence and save them here
-            index = 0
-            if self.batch_job_slice == 0:
-                max_index = self.loads.size() - JOB_SEQUENCE_SIZE - 1
-            else:
-                max_index = min(self.batch_job_slice, self.loads.size()) - JOB_SEQUENCE_SIZE - 1
-            print("max index... initializing SJF Score Array", max_index)
-
-            while index <= max_index:
-                index += 1
-                if index % 100 == 0:
-                    print("index", index)
-
-                self.cluster.reset()
-                self.loads.reset()
-
-                self.job_queue = []
-                self.running_jobs = []
-                self.visible_jobs = []
-                self.pairs = []
-
-                self.current_timestamp = 0
-                self.start = 0
-                self.next_arriving_job_idx = 0
-                self.last_job_in_batch = 0
-                self.num_job_in_batch = 0
-                self.scheduled_rl = {}
-                self.penalty = 0
-                self.pivot_job = False
-                self.scheduled_scores = []
-
-                job_sequence_size = JOB_SEQUENCE_SIZE
-                self.pre_workloads = []
-
-                self.start = index;
-                self.start_idx_last_reset = self.start
-                self.num_job_in_batch = job_sequence_size
-                self.last_job_in_batch = self.start + self.num_job_in_batch
-                self.current_timestamp = self.loads[self.start].submit_time
-                self.job_queue.append(self.loads[self.start])
-                self.next_arriving_job_idx = self.start + 1
-
-                if self.enable_preworkloads:
-                    self.gen_preworkloads(job_sequence_size + self.np_random.randint(job_sequence_size))
-
-                self.sjf_scores.append(sum(self.schedule_curr_sequence_reset(self.sjf_score).values()))
-
-            #print(self.sjf_scores)
+            # SJF scores of all the sample sequences, indexed by start index. They are computed once per
+            # workload and configuration by precompute_sjf.py (in parallel), here we just load them.
+            from precompute_sjf import load_sjf_scores
+            self.sjf_scores = load_sjf_scores(workload_file, self.loads.size(), self.loads.digest, backfil=self.backfil,
+                                              score_type=self.job_score_type, batch_job_slice=self.batch_job_slice,
+                                              cluster=self.cluster_model, cluster_policy=self.cluster_policy)
 
     def seed(self, seed=None):
         self.np_random, seed = seeding.np_random(seed)
         return [seed]
     
+    @staticmethod
+    def batch_score(batch_fn, job):
+        return batch_fn(job.submit_time, job.request_time, job.request_number_of_processors,
+                        job.scheduled_time - job.submit_time)[()]
+
     def f1_score(self, job):
-        submit_time = job.submit_time
-        request_processors = job.request_number_of_processors
-        request_time = job.request_time
-        # run_time = job.run_time
-        return (np.log10(request_time if request_time>0 else 0.1) * request_processors + 870 * np.log10(submit_time if submit_time>0 else 0.1))
+        return self.batch_score(f1_scores, job)
 
     def f2_score(self, job):
-        submit_time = job.submit_time
-        request_processors = job.request_number_of_processors
-        request_time = job.request_time
-        # run_time = job.run_time
-        # f2: r^(1/2)*n + 25600 * log10(s)
-        return (np.sqrt(request_time) * request_processors + 25600 * np.log10(submit_time))
+        return self.batch_score(f2_scores, job)
 
     def f3_score(self, job):
-        submit_time = job.submit_time
-        request_processors = job.request_number_of_processors
-        request_time = job.request_time
-        # run_time = job.run_time
-        # f3: r * n + 6860000 * log10(s)
-        return (request_time * request_processors + 6860000 * np.log10(submit_time))
+        return self.batch_score(f3_scores, job)
 
     def f4_score(self, job):
-        submit_time = job.submit_time
-        request_processors = job.request_number_of_processors
-        request_time = job.request_time
-        # run_time = job.run_time
-        # f4: r * sqrt(n) + 530000 * log10(s)
-        return (request_time * np.sqrt(request_processors) + 530000 * np.log10(submit_time))
+        return self.batch_score(f4_scores, job)
 
     def sjf_score(self, job):
         # run_time = job.run_time
@@ -213,19 +442,10 @@ class HPCEnv(gym.Env):
         return (request_processors, submit_time)
 
     def wfp_score(self, job):
-        submit_time = job.submit_time
-        request_processors = job.request_number_of_processors
-        request_time = job.request_time
-        waiting_time = job.scheduled_time-job.submit_time
-        return -np.power(float(waiting_time)/request_time, 3)*request_processors
-
-    def uni_score(self,job):
-        submit_time = job.submit_time
-        request_processors = job.request_number_of_processors
-        request_time = job.request_time
-        waiting_time = job.scheduled_time-job.submit_time
+        return self.batch_score(wfp_scores, job)
 
-        return -(waiting_time+1e-15)/(np.log2(request_processors+1e-15)*request_time)
+    def uni_score(self, job):
+        return self.batch_score(uni_scores, job)
 
     def fcfs_score(self, job):
         submit_time = job.submit_time
@@ -244,28 +464,27 @@ class HPCEnv(gym.Env):
             job_tmp.request_number_of_processors = req_num_of_processors
             job_tmp.run_time = runtime_of_job
             if self.cluster.can_allocated(job_tmp):
-                self.running_jobs.append(job_tmp)
                 job_tmp.scheduled_time = max(0, (self.current_timestamp - random.randint(0, max(runtime_of_job, 1))))
                 # job_tmp.scheduled_time = max(0, (self.current_timestamp - runtime_of_job/2))
                 job_tmp.allocated_machines = self.cluster.allocate(job_tmp.job_id, job_tmp.request_number_of_processors)
+                self.running_jobs.push(job_tmp)
                 self.pre_workloads.append(job_tmp)
             else:
                 break
 
     def refill_preworkloads(self):
         for _job in self.pre_workloads:
-            self.running_jobs.append(_job)
-            _job.allocated_machines = self.cluster.allocate(_job.job_id, _job.request_number_of_processors)    
+            _job.allocated_machines = self.cluster.allocate(_job.job_id, _job.request_number_of_processors)
+            self.running_jobs.push(_job)
 
     #@profile
     def reset(self):
         self.cluster.reset()
-        self.loads.reset()
+        self.window_jobs = {}
 
-        self.job_queue = []
-        self.running_jobs = []
+        self.job_queue = JobQueue()
+        self.running_jobs = RunningJobs()
         self.visible_jobs = []
-        self.pairs = []
 
         self.current_timestamp = 0
         self.start = 0
@@ -304,21 +523,24 @@ class HPCEnv(gym.Env):
         self.num_job_in_batch = job_sequence_size
         self.last_job_in_batch = self.start + self.num_job_in_batch
         self.current_timestamp = self.loads[self.start].submit_time
-        self.job_queue.append(self.loads[self.start])
+        self.job_queue.append(self.job(self.start))
         self.next_arriving_job_idx = self.start + 1
+        self.build_job_features()
 
         if self.enable_preworkloads:
             self.gen_preworkloads(job_sequence_size + self.np_random.randint(job_sequence_size))
 
-        self.scheduled_scores.append(sum(self.schedule_curr_sequence_reset(self.sjf_score).values()))
-        self.scheduled_scores.append(sum(self.schedule_curr_sequence_reset(self.f1_score).values()))
+        # computed before they are appended: a schedule restores the state, self.scheduled_scores included
+        baselines = [self.baseline_score(self.sjf_score), self.baseline_score(self.f1_score)]
+        self.scheduled_scores.extend(baselines)
         # self.scheduled_scores.append(sum(self.schedule_curr_sequence_reset(self.smallest_score).values()))
         # self.scheduled_scores.append(sum(self.schedule_curr_sequence_reset(self.fcfs_score).values()))
         #self.scheduled_scores.append(sum(self.schedule_curr_sequence_reset(self.f2_score).values()))
         #self.scheduled_scores.append(sum(self.schedule_curr_sequence_reset(self.f3_score).values()))
         #self.scheduled_scores.append(sum(self.schedule_curr_sequence_reset(self.f4_score).values()))        
 
-        return self.build_observation(), self.build_critic_observation()
+        obs = self.build_observation()
+        return obs, self.build_critic_observation(), self.action_mask
         
         #print(np.mean(self.scheduled_scores))
         '''
@@ -328,14 +550,37 @@ class HPCEnv(gym.Env):
             return self.reset()
         '''
 
+    def reset_for_sequence(self, start, job_sequence_size=JOB_SEQUENCE_SIZE):
+        # reset the environment to the sequence of job_sequence_size jobs beginning at start
+        self.cluster.reset()
+        self.window_jobs = {}
+
+        self.job_queue = JobQueue()
+        self.running_jobs = RunningJobs()
+        self.visible_jobs = []
+
+        self.scheduled_rl = {}
+        self.penalty = 0
+        self.pivot_job = False
+        self.scheduled_scores = []
+        self.pre_workloads = []
+
+        self.start = start
+        self.start_idx_last_reset = self.start
+        self.num_job_in_batch = job_sequence_size
+        self.last_job_in_batch = self.start + self.num_job_in_batch
+        self.current_timestamp = self.loads[self.start].submit_time
+        self.job_queue.append(self.job(self.start))
+        self.next_arriving_job_idx = self.start + 1
+        self.build_job_features()
+
     def reset_for_test(self, num,start):
         self.cluster.reset()
-        self.loads.reset()
+        self.window_jobs = {}
 
-        self.job_queue = []
-        self.running_jobs = []
+        self.job_queue = JobQueue()
+        self.running_jobs = RunningJobs()
         self.visible_jobs = []
-        self.pairs = []
 
         self.current_timestamp = 0
         self.start = 0
@@ -358,8 +603,9 @@ class HPCEnv(gym.Env):
         self.num_job_in_batch = job_sequence_size
         self.last_job_in_batch = self.start + self.num_job_in_batch
         self.current_timestamp = self.loads[self.start].submit_time
-        self.job_queue.append(self.loads[self.start])
+        self.job_queue.append(self.job(self.start))
         self.next_arriving_job_idx = self.start + 1
+        self.build_job_features()
     
     def skip_for_resources_greedy(self, job, scheduled_logs):
         #note that this function is only called when current job can not be scheduled.
@@ -368,66 +614,63 @@ class HPCEnv(gym.Env):
         while not self.cluster.can_allocated(job):
             # schedule nothing, just move forward to next timestamp. It should just add a new job or finish a running job
             assert self.running_jobs
-            self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.run_time))
-            next_resource_release_time = (self.running_jobs[0].scheduled_time + self.running_jobs[0].run_time)
-            next_resource_release_machines = self.running_jobs[0].allocated_machines
+            next_resource_release_time, next_resource_release_machines = self.next_resource_release()
 
             if self.next_arriving_job_idx < self.last_job_in_batch and self.loads[self.next_arriving_job_idx].submit_time <= next_resource_release_time:
                 self.current_timestamp = max(self.current_timestamp, self.loads[self.next_arriving_job_idx].submit_time)
-                self.job_queue.append(self.loads[self.next_arriving_job_idx])
+                self.job_queue.append(self.job(self.next_arriving_job_idx))
                 self.next_arriving_job_idx += 1
             else:
                 self.current_timestamp = max(self.current_timestamp, next_resource_release_time)
                 self.cluster.release(next_resource_release_machines)
-                self.running_jobs.pop(0)  # remove the first running job.
+                self.running_jobs.pop()  # remove the first finishing job.
 
     #@profile
     def moveforward_for_resources_backfill_greedy(self, job, scheduled_logs):
         #note that this function is only called when current job can not be scheduled.
         assert not self.cluster.can_allocated(job)
 
-        earliest_start_time = self.current_timestamp
-        # sort all running jobs by estimated finish time
-        self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.request_time))
-        free_processors = self.cluster.free_node * self.cluster.num_procs_per_node
-        for running_job in self.running_jobs:
-            free_processors += len(running_job.allocated_machines) * self.cluster.num_procs_per_node
-            earliest_start_time = (running_job.scheduled_time + running_job.request_time)
-            if free_processors >= job.request_number_of_processors:
-                break
+        # reserve the nodes of the job at the earliest time the running jobs are estimated to release enough of them
+        request_nodes = int(math.ceil(float(job.request_number_of_processors) / float(self.cluster.num_procs_per_node)))
+        earliest_start_time = self.running_jobs.earliest_start(self.cluster.free_node, request_nodes)
+        if earliest_start_time is None:
+            earliest_start_time = self.current_timestamp
 
+        # try to backfill as many jobs as possible. Use FCFS
+        candidates = self.job_queue.fcfs_order()
         while not self.cluster.can_allocated(job):
-
-            # try to backfill as many jobs as possible. Use FCFS
-            self.job_queue.sort(key=lambda _j: self.fcfs_score(_j))
-            job_queue_iter_copy = list(self.job_queue)
-            for _j in job_queue_iter_copy:
-                if (self.current_timestamp + _j.request_time) < earliest_start_time:
-                    if self.cluster.can_allocated(_j):
-                        # we should be OK to schedule the job now
-                        assert _j.scheduled_time == -1  # this job should never be scheduled before.
-                        _j.scheduled_time = self.current_timestamp
-                        _j.allocated_machines = self.cluster.allocate(_j.job_id, _j.request_number_of_processors)
-                        self.running_jobs.append(_j)
-                        score = self.job_score(_j)   # calculated reward
-                        scheduled_logs[_j.job_id] = score
-                        self.job_queue.remove(_j)  # remove the job from job queue
+            self.backfill_jobs(candidates, earliest_start_time, scheduled_logs)
 
             # move to the next timestamp
             assert self.running_jobs
-            self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.run_time))
-            next_resource_release_time = (self.running_jobs[0].scheduled_time + self.running_jobs[0].run_time)
-            next_resource_release_machines = self.running_jobs[0].allocated_machines
+            next_resource_release_time, next_resource_release_machines = self.next_resource_release()
                 
             if self.next_arriving_job_idx < self.last_job_in_batch \
             and self.loads[self.next_arriving_job_idx].submit_time <= next_resource_release_time:
                 self.current_timestamp = max(self.current_timestamp, self.loads[self.next_arriving_job_idx].submit_time)
-                self.job_queue.append(self.loads[self.next_arriving_job_idx])
+                # nothing was released and time went on: only the new job can be backfilled
+                candidates = [self.job(self.next_arriving_job_idx)]
+                self.job_queue.append(candidates[0])
                 self.next_arriving_job_idx += 1
             else:
                 self.current_timestamp = max(self.current_timestamp, next_resource_release_time)
                 self.cluster.release(next_resource_release_machines)
-                self.running_jobs.pop(0)  # remove the first running job
+                self.running_jobs.pop()  # remove the first finishing job.
+                candidates = self.job_queue.fcfs_order()
+
+    def backfill_jobs(self, jobs, earliest_start_time, scheduled_logs):
+        # start the jobs (in the given order) that fit in the free nodes and are estimated to finish before the
+        # reservation.
+        for _j in jobs:
+            if (self.current_timestamp + _j.request_time) < earliest_start_time and self.cluster.can_allocated(_j):
+                # we should be OK to schedule the job now
+                assert _j.scheduled_time == -1  # this job should never be scheduled before.
+                _j.scheduled_time = self.current_timestamp
+                _j.allocated_machines = self.cluster.allocate(_j.job_id, _j.request_number_of_processors)
+                self.running_jobs.push(_j)
+                score = self.job_score(_j)   # calculated reward
+                scheduled_logs[_j.job_id] = score
+                self.job_queue.remove(_j)  # remove the job from job queue
 
     def post_process_score(self, scheduled_logs):
         if self.job_score_type == 0:
@@ -453,16 +696,22 @@ class HPCEnv(gym.Env):
             raise NotImplementedError
     #@profile
     def schedule_curr_sequence_reset(self, score_fn):
-        # schedule the sequence of jobs using heuristic algorithm. 
+        # schedule the sequence of jobs using heuristic algorithm, then go back to the state it started from.
+        state = self.snapshot()
         scheduled_logs = {}
         # f = False
         # if score_fn.__name__ == "sjf_score":
         #     f = True
         #     num_total = 0
         # start_time = time.time()
+        rank = self.window_rank(score_fn)
+        if rank is not None:
+            rank = rank.tolist()
+            self.job_queue.order_by(lambda job: rank[job.trace_idx - self.window_start])
+        else:
+            self.job_queue.order_by(score_fn)
         while True:
-            self.job_queue.sort(key=lambda j: score_fn(j))
-            job_for_scheduling = self.job_queue[0]
+            job_for_scheduling = self.job_queue.best()
             # if f:
             #     num_total += 1
             # if selected job needs more resources, skip scheduling and try again after adding new jobs or releasing some resources
@@ -476,7 +725,7 @@ class HPCEnv(gym.Env):
             job_for_scheduling.scheduled_time = self.current_timestamp
             job_for_scheduling.allocated_machines = self.cluster.allocate(job_for_scheduling.job_id,
                                                                         job_for_scheduling.request_number_of_processors)
-            self.running_jobs.append(job_for_scheduling)
+            self.running_jobs.push(job_for_scheduling)
             score = self.job_score(job_for_scheduling)  # calculated reward
             scheduled_logs[job_for_scheduling.job_id] = score
             self.job_queue.remove(job_for_scheduling)
@@ -488,22 +737,55 @@ class HPCEnv(gym.Env):
         # if f:
         #     print((time.time()-start_time)/num_total, num_total)
         # reset again
-        self.cluster.reset()
-        self.loads.reset()
-        self.job_queue = []
-        self.running_jobs = []
-        self.visible_jobs = []
-        self.pairs = []
-        self.current_timestamp = self.loads[self.start].submit_time
-        self.job_queue.append(self.loads[self.start])
-        self.last_job_in_batch = self.start + self.num_job_in_batch
-        self.next_arriving_job_idx = self.start + 1
-
-        if self.enable_preworkloads:
-            self.refill_preworkloads()
-
+        self.restore(state)
         return scheduled_logs
 
+    def snapshot(self):
+        """
+        The state of the sequence being simulated, to come back to with restore (as many times as needed): copies
+        of the wait queue, the running jobs, the cluster allocation, the clock and the other SNAPSHOT_ATTRS, and
+        the scheduled time and nodes of the jobs of the window that are scheduled already. Nothing outside of the
+        window is copied or reset (see job), so branching several rollouts from the same point of a sequence costs
+        O(window), not a reset of the whole trace and a new schedule from its start.
+        """
+        scheduled = [(job, job.scheduled_time, job.allocated_machines)
+                     for job in self.window_jobs.values() if job.scheduled_time != -1]
+        return {"attrs": {name: copy.copy(getattr(self, name)) for name in SNAPSHOT_ATTRS},
+                "job_queue": self.job_queue.copy(), "running_jobs": self.running_jobs.copy(),
+                "cluster": self.cluster.snapshot(), "scheduled": scheduled}
+
+    def restore(self, state):
+        # go back to a snapshot of this environment; the observation and action mask are the ones it was taken with
+        window = (self.window_start, self.last_job_in_batch)
+        for name, value in state["attrs"].items():
+            setattr(self, name, copy.copy(value))
+        self.job_queue = state["job_queue"].copy()
+        self.running_jobs = state["running_jobs"].copy()
+        self.cluster.restore(state["cluster"])
+        # the jobs scheduled since the snapshot wait again
+        for job in self.window_jobs.values():
+            job.scheduled_time = -1
+        for job, scheduled_time, allocated_machines in state["scheduled"]:
+            job.scheduled_time = scheduled_time
+            job.allocated_machines = allocated_machines
+        if (self.window_start, self.last_job_in_batch) != window:
+            self.build_job_features()
+
+    def baseline_score(self, score_fn):
+        # total score of scheduling the current sequence with a heuristic, i.e. sum(schedule_curr_sequence_reset(score_fn)).
+        # it only depends on the sequence and the configuration, so it is looked up in the baseline cache first.
+        # randomly generated pre-workloads make each run different, those are never cached.
+        if self.baselines is None or self.enable_preworkloads:
+            return sum(self.schedule_curr_sequence_reset(score_fn).values())
+
+        key = (self.start, self.num_job_in_batch, score_fn.__name__, int(self.backfil), self.job_score_type,
+               cluster_key(self.cluster_model, self.cluster_policy))
+        score = self.baselines.get(key)
+        if score is None:
+            score = sum(self.schedule_curr_sequence_reset(score_fn).values())
+            self.baselines.put(key, score)
+        return score
+
     def build_critic_observation(self):
         vector = np.zeros(JOB_SEQUENCE_SIZE * 3,dtype=float)
         earlist_job = self.loads[self.start_idx_last_reset]
@@ -526,215 +808,182 @@ class HPCEnv(gym.Env):
 
         return vector
 
+    def build_job_features(self):
+        # the part of a job's observation that does not change over time is normalized once per window of the trace
+        # (the jobs [self.start, self.last_job_in_batch) that can enter the queue), so that memory does not grow
+        # with the trace. They are indexed by trace index - self.window_start.
+        # columns: normalized run time, request nodes, request memory, user id, group id, executable id.
+        # if a value does not exist in the trace (-1), we set it to 1 by default.
+        self.window_start = self.start
+        window = slice(self.start, self.last_job_in_batch)
+        columns = {name: np.asarray(self.loads.columns[name][window])
+                   for name in ["submit_time", "request_time", "request_number_of_processors", "request_memory",
+                                "user_id", "group_id", "executable_number"]}
+        features = np.empty((len(columns["submit_time"]), JOB_FEATURES - 2), dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            features[:, 0] = np.minimum(columns["request_time"] / float(self.loads.max_exec_time), 1.0 - 1e-5)
+            features[:, 1] = np.minimum(columns["request_number_of_processors"] / float(self.loads.max_procs), 1.0 - 1e-5)
+            for i, (name, max_value) in enumerate([("request_memory", self.loads.max_requested_memory),
+                                                   ("user_id", self.loads.max_user_id),
+                                                   ("group_id", self.loads.max_group_id),
+                                                   ("executable_number", self.loads.max_executable_number)], 2):
+                features[:, i] = np.where(columns[name] == -1, 1,
+                                          np.minimum(columns[name] / float(max_value), 1.0 - 1e-5))
+        self.job_features = features
+        self.job_request_nodes = np.ceil(columns["request_number_of_processors"] /
+                                         float(self.cluster.num_procs_per_node)).astype(np.int64)
+
+        # position of every job of the window in the FCFS, SJF and smallest-first orders.
+        # ties are broken by trace order, as the stable sorts of a job queue kept in arrival order do.
+        window_order = np.arange(len(features))
+        self.fcfs_rank = self.rank(np.lexsort((window_order, columns["submit_time"])))
+        self.sjf_rank = self.rank(np.lexsort((window_order, columns["submit_time"], columns["request_time"])))
+        self.smallest_rank = self.rank(np.lexsort((window_order, columns["submit_time"],
+                                                   columns["request_number_of_processors"])))
+
+        # the keys the observation sorts the queue on, as ranks that are equal for equal keys. The observation
+        # used to be built with successive stable sorts of the queue in place: by FCFS, then, for a queue longer
+        # than MAX_QUEUE_SIZE, by F1, F2, SJF and smallest. Chained, these sort SJF ties on F2 then F1, smallest
+        # ties on SJF, and leave the remaining ties in queue order, see JobQueue.position.
+        scores = (columns["submit_time"], columns["request_time"], columns["request_number_of_processors"],
+                  -1 - columns["submit_time"])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f1, f2 = f1_scores(*scores), f2_scores(*scores)
+        self.job_queue.observe_by({"fcfs": self.tie_rank(columns["submit_time"]),
+                                   "sjf": self.tie_rank(columns["request_time"], columns["submit_time"], f2, f1),
+                                   "smallest": self.tie_rank(columns["request_number_of_processors"],
+                                                             columns["submit_time"], columns["request_time"], f2,
+                                                             f1)},
+                                  self.window_start)
+
+    def window_rank(self, score_fn):
+        # position of every job of the window in the order of score_fn (ties broken by trace order, i.e. arrival),
+        # all the jobs scored at once; None for a score_fn with no batch version, which is then called per job.
+        name = getattr(score_fn, "__name__", None)
+        ranks = {"fcfs_score": self.fcfs_rank, "sjf_score": self.sjf_rank, "smallest_score": self.smallest_rank}
+        if name in ranks:
+            return ranks[name]
+        if name not in BATCH_SCORES:
+            return None
+        window = slice(self.window_start, self.last_job_in_batch)
+        submit_time = np.asarray(self.loads.columns["submit_time"][window])
+        # a job waiting in the queue has scheduled_time -1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = BATCH_SCORES[name](submit_time, np.asarray(self.loads.columns["request_time"][window]),
+                                        np.asarray(self.loads.columns["request_number_of_processors"][window]),
+                                        -1 - submit_time)
+        return self.rank(np.lexsort((np.arange(len(scores)), scores)))
+
+    @staticmethod
+    def rank(order):
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return rank
+
+    @staticmethod
+    def tie_rank(*keys):
+        # rank of every job in the order of keys (the first one is the most significant), the same for equal keys
+        order = np.lexsort(keys[::-1])
+        new_key = np.zeros(len(order), dtype=bool)
+        for key in keys:
+            sorted_key = key[order]
+            new_key[1:] |= sorted_key[1:] != sorted_key[:-1]
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.cumsum(new_key)
+        return rank
+
     def build_observation(self):
-        vector = np.zeros((MAX_QUEUE_SIZE) * JOB_FEATURES, dtype=float)
-        self.job_queue.sort(key=lambda job: self.fcfs_score(job))
-        self.visible_jobs = []
-        for i in range(0, MAX_QUEUE_SIZE):
-            if i < len(self.job_queue):
-                self.visible_jobs.append(self.job_queue[i])
-            else:
-                break
-        self.visible_jobs.sort(key=lambda j: self.fcfs_score(j))
+        # ties are broken by position in the queue, i.e. the order the previous sorts left the jobs in, see JobQueue
+        queue_length = len(self.job_queue)
+        # the old observation also shuffled jobs it did not use in the end: the FCFS view with shuffle on, and a
+        # random view of a long queue. The same draws are made, as gen_preworkloads draws from the same stream.
         if self.shuffle:
-            random.shuffle(self.visible_jobs)
-
-
-        #@ddai: optimize the observable jobs
-        self.visible_jobs = []
-        if len(self.job_queue) <= MAX_QUEUE_SIZE:
-            for i in range(0, len(self.job_queue)):
-                self.visible_jobs.append(self.job_queue[i])
+            shuffle_draws(min(queue_length, MAX_QUEUE_SIZE))
+        if queue_length > MAX_QUEUE_SIZE:
+            shuffle_draws(queue_length)
+        if queue_length <= MAX_QUEUE_SIZE:
+            self.visible_jobs = self.job_queue.first("fcfs", MAX_QUEUE_SIZE)
         else:
-            visible_f1 = []
-            f1_index = 0
-            self.job_queue.sort(key=lambda job: self.f1_score(job))
-            for i in range(0, MAX_QUEUE_SIZE):
-                visible_f1.append(self.job_queue[i])
-            
-            visible_f2 = []
-            f2_index = 0
-            self.job_queue.sort(key=lambda job: self.f2_score(job))
-            for i in range(0, MAX_QUEUE_SIZE):
-                visible_f2.append(self.job_queue[i])
-            
-            visible_sjf = []
-            sjf_index = 0
-            self.job_queue.sort(key=lambda job: self.sjf_score(job))
-            for i in range(0, MAX_QUEUE_SIZE):
-                visible_sjf.append(self.job_queue[i])
-
-            visible_small = []
-            small_index = 0
-            self.job_queue.sort(key=lambda job: self.smallest_score(job))
-            for i in range(0, MAX_QUEUE_SIZE):
-                visible_small.append(self.job_queue[i])
-
-            visible_random = []
-            random_index = 0
-            shuffled = list(self.job_queue)
-            shuffle(shuffled)
-            for i in range(0, MAX_QUEUE_SIZE):
-                visible_random.append(shuffled[i])
-
-            index = 0
-
-            while index < MAX_QUEUE_SIZE:
-                f1_job = visible_f1[f1_index]
-                f1_index += 1
-                f2_job = visible_f2[f2_index]
-                f2_index += 1
-                sjf_job = visible_sjf[sjf_index]
-                sjf_index += 1
-                small_job = visible_small[small_index]
-                small_index += 1
-                random_job = visible_sjf[random_index]
-                random_index += 1
-                #if (not f1_job in self.visible_jobs) and index < MAX_QUEUE_SIZE:
-                #    self.visible_jobs.append(f1_job)
-                #    index += 1
-                #if (not f2_job in self.visible_jobs) and index < MAX_QUEUE_SIZE:
-                #    self.visible_jobs.append(f2_job)
-                #    index += 1
-                if (not sjf_job in self.visible_jobs) and index < MAX_QUEUE_SIZE:
-                    self.visible_jobs.append(sjf_job)
-                    index += 1
-                if (not small_job in self.visible_jobs) and index < MAX_QUEUE_SIZE:
-                    self.visible_jobs.append(small_job)
-                    index += 1
-                if (not random_job in self.visible_jobs) and index < MAX_QUEUE_SIZE:
-                    self.visible_jobs.append(random_job)
-                    index += 1
-
-
-        '''
-        @ddai: OPTIMIZE_OBSV. This time, we calculate the earliest start time of each job and expose that to the RL agent.
-        if it is 0, then the job can start now, if it is near 1, that means it will have to wait for a really long time to start.
-        The earliest start time is calculated based on current resources and the running jobs. It assumes no more jobs will be scheduled.
-
-        # calculate the free resources at each outstanding ts
-        free_processors_pair = []
-        free_processors = (self.cluster.free_node * self.cluster.num_procs_per_node)
-        free_processors_pair.append((free_processors, 0))
-
-        self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.run_time))
-        for rj in self.running_jobs:
-            free_processors += rj.request_number_of_processors
-            free_processors_pair.append((free_processors, (rj.scheduled_time + rj.run_time - self.current_timestamp)))
-        '''
-
-        self.pairs = []
-        add_skip = False
-        for i in range(0, MAX_QUEUE_SIZE):
-            if i < len(self.visible_jobs) and i < (MAX_QUEUE_SIZE ):
-                job = self.visible_jobs[i]
-                submit_time = job.submit_time
-                request_processors = job.request_number_of_processors
-                request_time = job.request_time
-                # run_time = job.run_time
-                wait_time = self.current_timestamp - submit_time
-
-                # make sure that larger value is better.
-                normalized_wait_time = min(float(wait_time) / float(MAX_WAIT_TIME), 1.0 - 1e-5)
-                normalized_run_time = min(float(request_time) / float(self.loads.max_exec_time), 1.0 - 1e-5)
-                normalized_request_nodes = min(float(request_processors) / float(self.loads.max_procs),  1.0 - 1e-5)
-
-                '''
-                @ddai: part 2 of OPTIMIZE_OBSV
-                earliest_start_time = 1
-                for fp, ts in free_processors_pair:
-                    if request_processors < fp:
-                        earliest_start_time = ts
-                        break
-                normalized_earliest_start_time = min(float(earliest_start_time) / float(MAX_WAIT_TIME), 1.0 - 1e-5)
-                '''
-
-                # add extra parameters, include "Requested Memory", "User Id", "Groupd Id", "Exectuable Id", if its value does not exist in the trace (-1), we set it to 1 by default.
-                if job.request_memory == -1:
-                    normalized_request_memory = 1
-                else:
-                    normalized_request_memory = min(float(job.request_memory)/float(self.loads.max_requested_memory), 1.0 - 1e-5)
-
-                if job.user_id == -1:
-                    normalized_user_id = 1
-                else:
-                    normalized_user_id = min(float(job.user_id)/float(self.loads.max_user_id), 1.0-1e-5)
-
-                if job.group_id == -1:
-                    normalized_group_id = 1
-                else:
-                    normalized_group_id = min(float(job.group_id)/float(self.loads.max_group_id), 1.0-1e-5)
-
-                if job.executable_number == -1:
-                    normalized_executable_id = 1
-                else:
-                    normalized_executable_id = min(float(job.executable_number)/float(self.loads.max_executable_number), 1.0-1e-5)
-
-                if self.cluster.can_allocated(job):
-                    can_schedule_now = 1.0 - 1e-5
-                else:
-                    can_schedule_now = 1e-5
-                self.pairs.append([job,normalized_wait_time, normalized_run_time, normalized_request_nodes, normalized_request_memory, normalized_user_id, normalized_group_id, normalized_executable_id, can_schedule_now])
-
-            elif self.skip and not add_skip:  # the next job is skip
-                add_skip = True
-                if self.pivot_job:
-                    self.pairs.append([None, 1, 1, 1, 1, 1, 1, 1, 1])
-                else:
-                    self.pairs.append([None, 1, 1, 1, 1, 1, 1, 1, 0])
-            else:
-                self.pairs.append([None,0,1,1,1,1,1,1,0])
-
-        for i in range(0, MAX_QUEUE_SIZE):
-            vector[i*JOB_FEATURES:(i+1)*JOB_FEATURES] = self.pairs[i][1:]
-
-        return vector
+            #@ddai: optimize the observable jobs
+            # take the shortest and the smallest jobs in turn, skipping the ones already taken.
+            candidates = {}
+            for pair in zip(self.job_queue.first("sjf", MAX_QUEUE_SIZE),
+                            self.job_queue.first("smallest", MAX_QUEUE_SIZE)):
+                for job in pair:
+                    candidates.setdefault(job.job_id, job)
+            self.visible_jobs = list(candidates.values())[:MAX_QUEUE_SIZE]
+            self.job_queue.sort_smallest_first()
+        visible = np.array([job.trace_idx for job in self.visible_jobs], dtype=np.int64) - self.window_start
+
+        # the positions that can be picked: the visible jobs, then skip unless the pivot job is reserved already
+        num_visible = len(visible)
+        self.action_mask = np.zeros(MAX_QUEUE_SIZE, dtype=bool)
+        self.action_mask[:num_visible] = True
+        if self.skip and num_visible < MAX_QUEUE_SIZE:
+            self.action_mask[num_visible] = not self.pivot_job
+
+        # features: wait time, run time, request nodes, request memory, user id, group id, executable id,
+        # can schedule now. Make sure that larger value is better.
+        vector = np.empty((MAX_QUEUE_SIZE, JOB_FEATURES), dtype=float)
+        wait_time = self.current_timestamp - self.loads.columns["submit_time"][visible + self.window_start]
+        vector[:num_visible, 0] = np.minimum(wait_time / float(MAX_WAIT_TIME), 1.0 - 1e-5)
+        vector[:num_visible, 1:JOB_FEATURES - 1] = self.job_features[visible]
+        vector[:num_visible, JOB_FEATURES - 1] = np.where(self.job_request_nodes[visible] <= self.cluster.free_node,
+                                                          1.0 - 1e-5, 1e-5)
+        vector[num_visible:] = [0, 1, 1, 1, 1, 1, 1, 0]
+        if self.skip and num_visible < MAX_QUEUE_SIZE:  # the next job is skip
+            vector[num_visible] = [1, 1, 1, 1, 1, 1, 1, 1 if self.pivot_job else 0]
+
+        return vector.reshape(-1)
+
+    def job(self, idx):
+        # the Job of trace index idx this environment schedules. The Job objects of the Workloads are never
+        # modified, so one Workloads can be shared by many environments: each environment schedules its own copies
+        # of the jobs of its current sequence, made as they are needed and dropped on the next reset, so a reset
+        # costs O(window) whatever the size of the trace.
+        job = self.window_jobs.get(idx)
+        if job is None:
+            job = self.window_jobs[idx] = self.loads[idx].copy()
+        return job
+
+    def visible_job(self, a):
+        # the job shown at position a of the last observation, None for the skip and the empty positions
+        if a < len(self.visible_jobs):
+            return self.visible_jobs[a]
+        return None
 
     #@profile
     def moveforward_for_resources_backfill(self, job):
         #note that this function is only called when current job can not be scheduled.
         assert not self.cluster.can_allocated(job)
 
-        earliest_start_time = self.current_timestamp
-        # sort all running jobs by estimated finish time
-        self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.request_time))
-        free_processors = self.cluster.free_node * self.cluster.num_procs_per_node
-        for running_job in self.running_jobs:
-            free_processors += len(running_job.allocated_machines) * self.cluster.num_procs_per_node
-            earliest_start_time = (running_job.scheduled_time + running_job.request_time)
-            if free_processors >= job.request_number_of_processors:
-                break
+        # reserve the nodes of the job at the earliest time the running jobs are estimated to release enough of them
+        request_nodes = int(math.ceil(float(job.request_number_of_processors) / float(self.cluster.num_procs_per_node)))
+        earliest_start_time = self.running_jobs.earliest_start(self.cluster.free_node, request_nodes)
+        if earliest_start_time is None:
+            earliest_start_time = self.current_timestamp
 
+        # try to backfill as many jobs as possible. Use FCFS
+        candidates = self.job_queue.fcfs_order()
         while not self.cluster.can_allocated(job):
-            # try to backfill as many jobs as possible. Use FCFS
-            self.job_queue.sort(key=lambda _j: self.fcfs_score(_j))
-            job_queue_iter_copy = list(self.job_queue)
-            for _j in job_queue_iter_copy:
-                if self.cluster.can_allocated(_j) and (self.current_timestamp + _j.request_time) < earliest_start_time:
-                    # we should be OK to schedule the job now
-                    assert _j.scheduled_time == -1  # this job should never be scheduled before.
-                    _j.scheduled_time = self.current_timestamp
-                    _j.allocated_machines = self.cluster.allocate(_j.job_id, _j.request_number_of_processors)
-                    self.running_jobs.append(_j)
-                    score = self.job_score(_j)   # calculated reward
-                    self.scheduled_rl[_j.job_id] = score
-                    self.job_queue.remove(_j)  # remove the job from job queue
+            self.backfill_jobs(candidates, earliest_start_time, self.scheduled_rl)
 
             # move to the next timestamp
             assert self.running_jobs
-            self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.run_time))
-            next_resource_release_time = (self.running_jobs[0].scheduled_time + self.running_jobs[0].run_time)
-            next_resource_release_machines = self.running_jobs[0].allocated_machines
+            next_resource_release_time, next_resource_release_machines = self.next_resource_release()
                 
             if self.next_arriving_job_idx < self.last_job_in_batch \
             and self.loads[self.next_arriving_job_idx].submit_time <= next_resource_release_time:
                 self.current_timestamp = max(self.current_timestamp, self.loads[self.next_arriving_job_idx].submit_time)
-                self.job_queue.append(self.loads[self.next_arriving_job_idx])
+                # nothing was released and time went on: only the new job can be backfilled
+                candidates = [self.job(self.next_arriving_job_idx)]
+                self.job_queue.append(candidates[0])
                 self.next_arriving_job_idx += 1
             else:
                 self.current_timestamp = max(self.current_timestamp, next_resource_release_time)
                 self.cluster.release(next_resource_release_machines)
-                self.running_jobs.pop(0)  # remove the first running job
+                self.running_jobs.pop()  # remove the first finishing job.
+                candidates = self.job_queue.fcfs_order()
     
     def skip_for_resources(self, job):
         #note that this function is only called when current job can not be scheduled.
@@ -743,18 +992,16 @@ class HPCEnv(gym.Env):
         while not self.cluster.can_allocated(job):
             # schedule nothing, just move forward to next timestamp. It should just add a new job or finish a running job
             assert self.running_jobs
-            self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.run_time))
-            next_resource_release_time = (self.running_jobs[0].scheduled_time + self.running_jobs[0].run_time)
-            next_resource_release_machines = self.running_jobs[0].allocated_machines
+            next_resource_release_time, next_resource_release_machines = self.next_resource_release()
 
             if self.next_arriving_job_idx < self.last_job_in_batch and self.loads[self.next_arriving_job_idx].submit_time <= next_resource_release_time:
                 self.current_timestamp = max(self.current_timestamp, self.loads[self.next_arriving_job_idx].submit_time)
-                self.job_queue.append(self.loads[self.next_arriving_job_idx])
+                self.job_queue.append(self.job(self.next_arriving_job_idx))
                 self.next_arriving_job_idx += 1
             else:
                 self.current_timestamp = max(self.current_timestamp, next_resource_release_time)
                 self.cluster.release(next_resource_release_machines)
-                self.running_jobs.pop(0)  # remove the first running job.
+                self.running_jobs.pop()  # remove the first finishing job.
 
     #@profile
     def moveforward_for_job(self):
@@ -768,23 +1015,18 @@ class HPCEnv(gym.Env):
 
         # move forward to add jobs into job queue.
         while not self.job_queue:
-            if not self.running_jobs:  # there are no running jobs
-                next_resource_release_time = sys.maxsize  # always add jobs if no resource can be released.
-                next_resource_release_machines = []
-            else:
-                self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.run_time))
-                next_resource_release_time = (self.running_jobs[0].scheduled_time + self.running_jobs[0].run_time)
-                next_resource_release_machines = self.running_jobs[0].allocated_machines
+            # always add jobs if no resource can be released.
+            next_resource_release_time, next_resource_release_machines = self.next_resource_release()
 
             if self.loads[self.next_arriving_job_idx].submit_time <= next_resource_release_time:
                 self.current_timestamp = max(self.current_timestamp, self.loads[self.next_arriving_job_idx].submit_time)
-                self.job_queue.append(self.loads[self.next_arriving_job_idx])
+                self.job_queue.append(self.job(self.next_arriving_job_idx))
                 self.next_arriving_job_idx += 1
                 return True     # job added
             else:
                 self.current_timestamp = max(self.current_timestamp, next_resource_release_time)
                 self.cluster.release(next_resource_release_machines)
-                self.running_jobs.pop(0)  # remove the first running job.
+                self.running_jobs.pop()  # remove the first finishing job.
 
     def job_score(self, job_for_scheduling):
 
@@ -815,6 +1057,13 @@ class HPCEnv(gym.Env):
         #_tmp = _tmp * (job_for_scheduling.run_time * job_for_scheduling.request_number_of_processors)
         return _tmp
 
+    def next_resource_release(self):
+        # the earliest finishing running job decides the next release event; sys.maxsize if nothing is running
+        if not self.running_jobs:
+            return sys.maxsize, []
+        running_job = self.running_jobs.peek()
+        return running_job.scheduled_time + running_job.run_time, running_job.allocated_machines
+
     def has_only_one_job(self):
         if len(self.job_queue) == 1:
             return True
@@ -825,12 +1074,8 @@ class HPCEnv(gym.Env):
         # schedule nothing, just move forward to next timestamp. It should 1) add a new job; 2) finish a running job; 3) reach skip time
         next_time_after_skip = self.current_timestamp + SKIP_TIME
 
-        next_resource_release_time = sys.maxsize  # always add jobs if no resource can be released.
-        next_resource_release_machines = []
-        if self.running_jobs:  # there are running jobs
-            self.running_jobs.sort(key=lambda running_job: (running_job.scheduled_time + running_job.run_time))
-            next_resource_release_time = (self.running_jobs[0].scheduled_time + self.running_jobs[0].run_time)
-            next_resource_release_machines = self.running_jobs[0].allocated_machines
+        # always add jobs if no resource can be released.
+        next_resource_release_time, next_resource_release_machines = self.next_resource_release()
 
         if self.next_arriving_job_idx >= self.last_job_in_batch and not self.running_jobs:
             if not self.pivot_job:
@@ -845,12 +1090,12 @@ class HPCEnv(gym.Env):
         
         if self.next_arriving_job_idx < self.last_job_in_batch and self.loads[self.next_arriving_job_idx].submit_time <= next_resource_release_time:
             self.current_timestamp = max(self.current_timestamp, self.loads[self.next_arriving_job_idx].submit_time)
-            self.job_queue.append(self.loads[self.next_arriving_job_idx])
+            self.job_queue.append(self.job(self.next_arriving_job_idx))
             self.next_arriving_job_idx += 1
         else:
             self.current_timestamp = max(self.current_timestamp, next_resource_release_time)
             self.cluster.release(next_resource_release_machines)
-            self.running_jobs.pop(0)  # remove the first running job.
+            self.running_jobs.pop()  # remove the first finishing job.
         return False, 0
 
     def schedule(self, job_for_scheduling):
@@ -865,7 +1110,7 @@ class HPCEnv(gym.Env):
         assert job_for_scheduling.scheduled_time == -1  # this job should never be scheduled before.
         job_for_scheduling.scheduled_time = self.current_timestamp
         job_for_scheduling.allocated_machines = self.cluster.allocate(job_for_scheduling.job_id, job_for_scheduling.request_number_of_processors)
-        self.running_jobs.append(job_for_scheduling)
+        self.running_jobs.push(job_for_scheduling)
         score = self.job_score(job_for_scheduling)   # calculated reward
         self.scheduled_rl[job_for_scheduling.job_id] = score
         self.job_queue.remove(job_for_scheduling)  # remove the job from job queue
@@ -882,20 +1127,19 @@ class HPCEnv(gym.Env):
 
     def valid(self, a):
         action = a[0]
-        return self.pairs[action][0]
+        return self.visible_job(action)
 
     #@profile
     def step(self, a):
-        job_for_scheduling = self.pairs[a][0]
+        job_for_scheduling = self.visible_job(a)
         if not job_for_scheduling:
             done, _ = self.skip_schedule()
         else:
-            job_for_scheduling = self.pairs[a][0]
             done = self.schedule(job_for_scheduling)            
 
         if not done:
             obs = self.build_observation()
-            return [obs, 0, False, 0, 0, 0]
+            return [obs, 0, False, 0, 0, 0, self.action_mask]
         else:
             self.post_process_score(self.scheduled_rl)
             rl_total = sum(self.scheduled_rl.values())
@@ -912,21 +1156,20 @@ class HPCEnv(gym.Env):
             else:
                 rwd = 1    
             '''
-            return [None, rwd, True, rwd2, sjf, f1]
+            return [None, rwd, True, rwd2, sjf, f1, None]
     
     def step_for_test(self, a):
-        job_for_scheduling = self.pairs[a][0]
+        job_for_scheduling = self.visible_job(a)
 
         if not job_for_scheduling:
             # print("SKIP", end=" ")
             done, _ = self.skip_schedule()
         else:
-            job_for_scheduling = self.pairs[a][0]
             done = self.schedule(job_for_scheduling)
 
         if not done:
             obs = self.build_observation()
-            return [obs, 0, False, None]
+            return [obs, 0, False, self.action_mask]
         else:
             self.post_process_score(self.scheduled_rl)
             rl_total = sum(self.scheduled_rl.values())
@@ -0,0 +1,69 @@
+import time
+import sqlite3
+
+# part of every key: bump this whenever a change to the simulator changes the schedules of the heuristics (e.g.
+# how ties are broken), so that the scores computed by the previous versions are not used any more.
+BASELINE_VERSION = 1
+
+
+class BaselineCache:
+    """
+    An on-disk table of heuristic baseline scores, shared by all the processes using the same file.
+    A baseline only depends on the trace, the sequence (start index and length), the policy and the
+    scheduler configuration, so it is computed once and looked up afterwards.
+    The table keeps at most max_entries scores and evicts the least recently used ones.
+    It is only a cache: any database error is reported as a miss.
+    """
+    def __init__(self, path, digest, max_entries=1000000):
+        self.path = path
+        self.digest = digest
+        self.max_entries = max_entries
+        self.num_puts = 0
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS baselines "
+                              "(key TEXT PRIMARY KEY, score REAL, last_used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS baselines_last_used ON baselines (last_used)")
+        return self.conn
+
+    def make_key(self, key):
+        return ":".join([self.digest, "v" + str(BASELINE_VERSION)] + [str(k) for k in key])
+
+    def get(self, key):
+        key = self.make_key(key)
+        try:
+            conn = self.connect()
+            row = conn.execute("SELECT score FROM baselines WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE baselines SET last_used = ? WHERE key = ?", (time.time(), key))
+        except sqlite3.Error:
+            return None
+        return row[0]
+
+    def put(self, key, score):
+        try:
+            conn = self.connect()
+            conn.execute("INSERT OR REPLACE INTO baselines VALUES (?, ?, ?)", (self.make_key(key), score, time.time()))
+            self.num_puts += 1
+            if self.num_puts % 1000 == 0:
+                self.evict()
+        except sqlite3.Error:
+            pass
+
+    def evict(self):
+        conn = self.connect()
+        num_entries = conn.execute("SELECT COUNT(*) FROM baselines").fetchone()[0]
+        if num_entries > self.max_entries:
+            conn.execute("DELETE FROM baselines WHERE key IN "
+                         "(SELECT key FROM baselines ORDER BY last_used LIMIT ?)", (num_entries - self.max_entries,))
+
+    def __getstate__(self):
+        # connections can not be pickled (e.g. when the environment is saved); reconnect on first use.
+        state = dict(self.__dict__)
+        state["conn"] = None
+        return state
@@ -0,0 +1,203 @@
+"""
+Micro-benchmarks of the simulator, without TensorFlow. For each trace, times the Workloads load (parsing and from
+the column cache), reset, build_observation and step with random valid actions, and a full schedule of a
+sequence with each heuristic, with and without backfilling. Reports ops/sec and p50/p99 latencies, in CPU time and
+from the fastest of --passes passes, as JSON.
+
+Latencies depend on the machine, and on how busy it is, so a fixed reference op (heap pushes and a NumPy sort) is
+timed right after each op, and each latency is also reported as the median of its ratios to those. The check
+against the stored baseline is on these ratios: it fails (exit code 1) when one grows more than --tolerance above
+the baseline's.
+
+    python benchmark.py --output results.json
+    python benchmark.py --save_baseline     # after a deliberate change, or on a new machine
+"""
+import os
+import sys
+import glob
+import json
+import time
+import heapq
+import platform
+import contextlib
+
+import numpy as np
+
+from job import Workloads
+from HPCSimPickJobs import HPCEnv, JOB_SEQUENCE_SIZE
+
+HEURISTICS = ["fcfs_score", "sjf_score", "smallest_score", "wfp_score", "uni_score", "f1_score"]
+BASELINE_FILE = "benchmark_baseline.json"
+
+
+REFERENCE_VALUES = np.random.RandomState(0).rand(5000)
+
+
+def timed(fn, *args):
+    # CPU time of this process: the time slices other processes get in between are not the simulator's
+    start = time.process_time()
+    result = fn(*args)
+    return time.process_time() - start, result
+
+
+def reference_op(values, items):
+    # a fixed mix of interpreter and NumPy work, the unit the latencies of an op are measured in
+    heap = []
+    for item in items:
+        heapq.heappush(heap, item)
+    np.sort(values)
+
+
+class Latencies:
+    """
+    Latencies of an op, each with the latency of the reference op timed right after it. A shared machine can run
+    the same op nearly 2x slower from one second to the next, while the ratio of two adjacent timings barely moves.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.references = []
+
+    def time(self, fn, *args):
+        elapsed, result = timed(fn, *args)
+        self.latencies.append(elapsed)
+        self.references.append(timed(reference_op, REFERENCE_VALUES, REFERENCE_VALUES.tolist())[0])
+        return result
+
+    def summary(self):
+        latencies = np.asarray(self.latencies)
+        references = np.asarray(self.references)
+        return {"n": len(latencies),
+                "ops_per_sec": len(latencies) / latencies.sum(),
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000),
+                "reference_p50_ms": float(np.percentile(references, 50) * 1000),
+                "p50_rel": float(np.percentile(latencies / references, 50))}
+
+
+def make_env(workload_file, backfil, seed):
+    # no baseline cache: reset should compute its heuristic baselines, not look them up.
+    env = HPCEnv(backfil=backfil, baseline_cache=False)
+    env.seed(seed)
+    env.my_init(workload_file=workload_file)
+    return env
+
+
+def bench_load(workload_file, repeat):
+    Workloads(workload_file)  # make sure the column cache exists
+    parse, cached = Latencies(), Latencies()
+    for _ in range(repeat):
+        parse.time(Workloads, workload_file, False)
+    for _ in range(repeat):
+        cached.time(Workloads, workload_file)
+    return {"load_parse": parse.summary(), "load_cache": cached.summary()}
+
+
+def bench_env(env, episodes, seed):
+    rng = np.random.RandomState(seed)
+    reset, observation, step = Latencies(), Latencies(), Latencies()
+    for _ in range(episodes):
+        o, co, mask = reset.time(env.reset)
+        done = False
+        while not done:
+            observation.time(env.build_observation)
+            mask = env.action_mask
+            o, r, done, r2, sjf, f1, _ = step.time(env.step, rng.choice(np.flatnonzero(mask)))
+    return {"reset": reset.summary(), "build_observation": observation.summary(), "step": step.summary()}
+
+
+def bench_heuristics(env, sequences, seed):
+    rng = np.random.RandomState(seed)
+    starts = rng.randint(JOB_SEQUENCE_SIZE, env.loads.size() - JOB_SEQUENCE_SIZE - 1, size=sequences)
+    results = {}
+    for name in HEURISTICS:
+        score_fn = getattr(env, name)
+        latencies = Latencies()
+        for start in starts:
+            env.reset_for_sequence(start)
+            latencies.time(env.schedule_curr_sequence_reset, score_fn)
+        results["schedule_" + name] = latencies.summary()
+    return results
+
+
+def bench_pass(workload_files, repeat, episodes, sequences, seed):
+    results = {}
+    for workload_file in workload_files:
+        trace = os.path.basename(workload_file)
+        for name, stats in bench_load(workload_file, repeat).items():
+            results[trace + "/" + name] = stats
+        for backfil in [False, True]:
+            env = make_env(workload_file, backfil, seed)
+            suffix = "/backfil" if backfil else ""
+            stats = bench_env(env, episodes, seed)
+            stats.update(bench_heuristics(env, sequences, seed))
+            for name in stats:
+                results[trace + "/" + name + suffix] = stats[name]
+    return results
+
+
+def run(workload_files, repeat, episodes, sequences, seed, passes):
+    # every pass runs the same ops on the same seeds, and each op keeps its fastest pass: the slow phases of the
+    # machine also slow the ops down relative to the reference op, the short ones up to 2x
+    results = {}
+    for _ in range(passes):
+        for key, stats in bench_pass(workload_files, repeat, episodes, sequences, seed).items():
+            if key not in results or stats["p50_rel"] < results[key]["p50_rel"]:
+                results[key] = stats
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    slower = []
+    for key, stats in sorted(results.items()):
+        # the median latency, as a few outliers on a busy machine move the mean a lot, relative to the reference
+        # op so that a baseline saved on another machine still applies
+        if key in baseline and stats["p50_rel"] > baseline[key]["p50_rel"] * (1 + tolerance):
+            slower.append("{}: p50 {:.2f}x reference, baseline {:.2f}x ({:.3f} ms, baseline {:.3f} ms)".format(
+                key, stats["p50_rel"], baseline[key]["p50_rel"], stats["p50_ms"], baseline[key]["p50_ms"]))
+    return slower
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workloads', type=str, nargs='+', default=sorted(glob.glob('./data/*.swf')))
+    parser.add_argument('--repeat', type=int, default=5)  # Workloads loads
+    parser.add_argument('--episodes', type=int, default=10)  # reset + steps until done
+    parser.add_argument('--sequences', type=int, default=20)  # schedules per heuristic
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--passes', type=int, default=3)  # keeps the fastest pass of each op
+    parser.add_argument('--output', type=str, default='')
+    parser.add_argument('--baseline', type=str, default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--save_baseline', action='store_true')
+    args = parser.parse_args()
+
+    workload_files = [os.path.join(os.getcwd(), w) for w in args.workloads]
+    # the environment reports what it loads on stdout, keep stdout for the report.
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(workload_files, args.repeat, args.episodes, args.sequences, args.seed, args.passes)
+    report = {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+              "processor": platform.processor(), "results": results}
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+        print("baseline saved to", args.baseline, file=sys.stderr)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            slower = regressions(results, json.load(fp)["results"], args.tolerance)
+        if slower:
+            print("regressions (p50 more than {:.0%} above {}):".format(args.tolerance, args.baseline),
+                  file=sys.stderr)
+            for line in slower:
+                print("  " + line, file=sys.stderr)
+            sys.exit(1)
+        print("no regression against", args.baseline, file=sys.stderr)
@@ -1,4 +1,7 @@
 import math
+import bisect
+
+import numpy as np
 
 
 class Machine:
@@ -170,4 +173,257 @@ class SimpleCluster:
         self.used_node = 0
         self.free_node = self.total_node
 
-Cluster = SimpleCluster
\ No newline at end of file
+    def snapshot(self):
+        # the allocation state, to go back to with restore
+        return self.used_node, self.free_node
+
+    def restore(self, state):
+        self.used_node, self.free_node = state
+
+
+def node_runs(nodes):
+    # (first node, end) of the runs of consecutive ids in sorted node ids
+    if len(nodes) == 0:
+        return [], []
+    gaps = np.flatnonzero(nodes[1:] - nodes[:-1] != 1)
+    return [int(nodes[0])] + nodes[gaps + 1].tolist(), (nodes[gaps] + 1).tolist() + [int(nodes[-1]) + 1]
+
+
+class FreeBlocks:
+    """
+    The runs of free nodes of a NodeCluster, indexed both by first node (a sorted list, to find the run a node is
+    in and the run before a released one) and by (length, first node) (a sorted list, to find the smallest run
+    that fits a job). Every lookup is a binary search; runs are split as nodes are taken and merged with their
+    neighbours as nodes are given back.
+    """
+    def __init__(self, total_node):
+        self.starts = []
+        self.lengths = {}
+        self.by_size = []
+        if total_node > 0:
+            self.add(0, total_node)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, length):
+        bisect.insort(self.starts, start)
+        bisect.insort(self.by_size, (length, start))
+        self.lengths[start] = length
+
+    def remove(self, start):
+        length = self.lengths.pop(start)
+        del self.starts[bisect.bisect_left(self.starts, start)]
+        del self.by_size[bisect.bisect_left(self.by_size, (length, start))]
+        return length
+
+    def take(self, first, end):
+        # nodes [first, end), all in one free run
+        start = self.starts[bisect.bisect_right(self.starts, first) - 1]
+        length = self.remove(start)
+        if first > start:
+            self.add(start, first - start)
+        if end < start + length:
+            self.add(end, start + length - end)
+
+    def give(self, first, end):
+        # nodes [first, end), none of them free, merged with the free runs right before and after
+        if end in self.lengths:
+            end += self.remove(end)
+        i = bisect.bisect_left(self.starts, first) - 1
+        if i >= 0 and self.starts[i] + self.lengths[self.starts[i]] == first:
+            first = self.starts[i]
+            self.remove(first)
+        self.add(first, end - first)
+
+    def best_fit(self, count, align=1):
+        # first node of the smallest run with count free nodes from a multiple of align, None if there is none
+        by_size = self.by_size
+        for i in range(bisect.bisect_left(by_size, (count, -1)), len(by_size)):
+            length, start = by_size[i]
+            first = -(-start // align) * align
+            if first + count <= start + length:
+                return first
+        return None
+
+    def largest(self):
+        return self.by_size[-1][0] if self.by_size else 0
+
+    def copy(self):
+        blocks = FreeBlocks(0)
+        blocks.starts, blocks.lengths, blocks.by_size = list(self.starts), dict(self.lengths), list(self.by_size)
+        return blocks
+
+
+class NodeCluster:
+    """
+    A cluster that places jobs on its nodes. self.free_map is a bool array, True for the free nodes, and
+    self.node_job holds the id of the job running on each node (-1 when free). allocate returns the ids of the
+    nodes given to a job as an array, and release frees them with one mask assignment. The runs of free nodes
+    are also indexed (see FreeBlocks), and the free nodes of each switch counted: nodes_per_switch consecutive
+    nodes share a leaf switch.
+    The nodes are picked by the allocation policy, the place_<policy> method:
+        first_fit: the free nodes with the lowest ids.
+        best_fit: the smallest run of free nodes the job fits in.
+        buddy: the smallest run holding the job at a multiple of its size rounded up to a power of two, as a buddy
+            allocator would place it (only the nodes of the job are taken).
+        switch: the fewest leaf switches, filling the ones with the fewest free nodes first.
+    The policies other than first_fit fall back on the previous one when they can not place a job, so every job
+    that can_allocated is placed: only which nodes are used differs from SimpleCluster, the node counts, so the
+    schedules, are the same. fragmentation() reports how scattered the free nodes and the jobs are.
+    """
+    def __init__(self, cluster_name, node_num, num_procs_per_node, policy="first_fit", nodes_per_switch=32):
+        self.name = cluster_name
+        self.total_node = int(node_num)
+        self.free_node = self.total_node
+        self.used_node = 0
+        self.num_procs_per_node = num_procs_per_node
+        self.policy = policy
+        self.nodes_per_switch = nodes_per_switch
+        if not hasattr(self, "place_" + policy):
+            raise ValueError("unknown allocation policy " + policy)
+        self.reset()
+
+    def feature(self):
+        return [self.free_node]
+
+    def can_allocated(self, job):
+        if job.request_number_of_nodes != -1:
+            return job.request_number_of_nodes <= self.free_node
+
+        request_node = int(math.ceil(float(job.request_number_of_processors)/float(self.num_procs_per_node)))
+        job.request_number_of_nodes = request_node
+        return request_node <= self.free_node
+
+    def place_first_fit(self, count):
+        return np.flatnonzero(self.free_map)[:count]
+
+    def place_best_fit(self, count):
+        first = self.free_blocks.best_fit(count)
+        if first is None:
+            return self.place_first_fit(count)
+        return np.arange(first, first + count)
+
+    def place_buddy(self, count):
+        first = self.free_blocks.best_fit(count, align=1 << (count - 1).bit_length())
+        if first is None:
+            return self.place_best_fit(count)
+        return np.arange(first, first + count)
+
+    def place_switch(self, count):
+        # the switches in the order they are filled: the fullest ones that can still hold the job alone, if any,
+        # otherwise the emptiest ones, so that the job spans as few switches as possible
+        fits = self.switch_free >= count
+        if fits.any():
+            switch = np.flatnonzero(fits)[np.argmin(self.switch_free[fits])]
+            lo = switch * self.nodes_per_switch
+            return np.flatnonzero(self.free_map[lo:lo + self.nodes_per_switch])[:count] + lo
+        order = np.argsort(-self.switch_free, kind="stable")
+        num_switches = np.searchsorted(np.cumsum(self.switch_free[order]), count) + 1
+        switches = np.sort(order[:num_switches])
+        nodes = np.flatnonzero(self.padded_map.reshape(-1, self.nodes_per_switch)[switches])
+        nodes = switches[nodes // self.nodes_per_switch] * self.nodes_per_switch + nodes % self.nodes_per_switch
+        return nodes[:count]
+
+    def allocate(self, job_id, request_num_procs):
+        request_node = int(math.ceil(float(request_num_procs) / float(self.num_procs_per_node)))
+        if request_node > self.free_node:
+            return []
+        if request_node == 0:
+            # a job without processors: it takes no nodes, and is not counted in the fragmentation averages
+            return np.empty(0, dtype=np.int64)
+
+        nodes = getattr(self, "place_" + self.policy)(request_node)
+        switches = nodes // self.nodes_per_switch
+        self.free_map[nodes] = False
+        self.node_job[nodes] = job_id
+        self.switch_free -= np.bincount(switches, minlength=len(self.switch_free))
+        firsts, ends = node_runs(nodes)
+        for first, end in zip(firsts, ends):
+            self.free_blocks.take(first, end)
+        self.num_allocations += 1
+        self.num_job_runs += len(firsts)
+        self.num_job_switches += 1 + np.count_nonzero(switches[1:] != switches[:-1])
+        self.used_node += request_node
+        self.free_node -= request_node
+        return nodes
+
+    def release(self, releases):
+        self.used_node -= len(releases)
+        self.free_node += len(releases)
+        self.free_map[releases] = True
+        self.node_job[releases] = -1
+        self.switch_free += np.bincount(releases // self.nodes_per_switch, minlength=len(self.switch_free))
+        for first, end in zip(*node_runs(releases)):
+            self.free_blocks.give(first, end)
+
+    def fragmentation(self):
+        # free_blocks: runs of free nodes; external: share of the free nodes outside the largest run, i.e. that a
+        # job as large as all the free nodes could not get contiguously; job_runs and job_switches: the average
+        # number of runs of nodes and of switches the jobs allocated since the last reset were spread on
+        largest = self.free_blocks.largest()
+        return {"free_nodes": self.free_node,
+                "free_blocks": len(self.free_blocks),
+                "largest_free_block": largest,
+                "external": 1.0 - float(largest) / self.free_node if self.free_node else 0.0,
+                "job_runs": float(self.num_job_runs) / self.num_allocations if self.num_allocations else 0.0,
+                "job_switches": float(self.num_job_switches) / self.num_allocations if self.num_allocations else 0.0}
+
+    def is_idle(self):
+        return self.used_node == 0
+
+    def reset(self):
+        self.used_node = 0
+        self.free_node = self.total_node
+        num_switches = -(-self.total_node // self.nodes_per_switch)
+        # the free map is padded to whole switches with nodes that are never free
+        self.padded_map = np.zeros(num_switches * self.nodes_per_switch, dtype=bool)
+        self.free_map = self.padded_map[:self.total_node]
+        self.free_map[:] = True
+        self.node_job = np.full(self.total_node, -1, dtype=np.int64)
+        self.switch_free = np.bincount(np.arange(self.total_node) // self.nodes_per_switch)
+        self.free_blocks = FreeBlocks(self.total_node)
+        self.num_allocations = 0
+        self.num_job_runs = 0
+        self.num_job_switches = 0
+
+    def snapshot(self):
+        # the allocation state, to go back to with restore (which copies it again, so it can be restored many times)
+        return (self.used_node, self.free_node, self.padded_map.copy(), self.node_job.copy(), self.switch_free.copy(),
+                self.free_blocks.copy(), self.num_allocations, self.num_job_runs, self.num_job_switches)
+
+    def restore(self, state):
+        (self.used_node, self.free_node, padded_map, node_job, switch_free, free_blocks,
+         self.num_allocations, self.num_job_runs, self.num_job_switches) = state
+        self.padded_map = padded_map.copy()
+        self.free_map = self.padded_map[:self.total_node]
+        self.node_job = node_job.copy()
+        self.switch_free = switch_free.copy()
+        self.free_blocks = free_blocks.copy()
+
+    def __setstate__(self, state):
+        # free_map is a view of padded_map, and a copy once unpickled
+        self.__dict__.update(state)
+        self.free_map = self.padded_map[:self.total_node]
+
+
+# the cluster models of the simulator, chosen with HPCEnv(cluster=..., cluster_policy=...): SimpleCluster only counts
+# nodes, NodeCluster places the jobs on nodes with one of the POLICIES. Baselines and precomputed SJF scores are
+# keyed by cluster_key, so they are not mixed up.
+CLUSTERS = {"simple": SimpleCluster, "node": NodeCluster}
+POLICIES = sorted(name[len("place_"):] for name in dir(NodeCluster) if name.startswith("place_"))
+Cluster = SimpleCluster
+
+
+def make_cluster(model, node_num, num_procs_per_node, policy="first_fit"):
+    if model not in CLUSTERS:
+        raise ValueError("unknown cluster model " + model)
+    if CLUSTERS[model] is NodeCluster:
+        return NodeCluster("Cluster", node_num, num_procs_per_node, policy=policy)
+    return CLUSTERS[model]("Cluster", node_num, num_procs_per_node)
+
+
+def cluster_key(model, policy="first_fit"):
+    if CLUSTERS[model] is NodeCluster:
+        return NodeCluster.__name__ + "-" + policy
+    return CLUSTERS[model].__name__
@@ -14,8 +14,9 @@ logging.getLogger('tensorflow').disabled = True
 
 
 from HPCSimPickJobs import *
+from vec_env import test_envs, run_test_sequences
+from cluster import CLUSTERS, POLICIES
 
-tf.enable_eager_execution()
 
 
 def load_policy(model_path, itr='last'):
@@ -58,7 +59,8 @@ def action_from_obs(o):
 
 
 # @profile
-def run_policy(env, get_probs, get_out, nums, iters, score_type):
+def run_policy(envs, get_probs, get_out, greedy, score_type):
+    # envs: one environment per test sequence, see vec_env.test_envs
     rl_r = []
     f1_r = []
     f2_r = []
@@ -69,65 +71,23 @@ def run_policy(env, get_probs, get_out, nums, iters, score_type):
 
     fcfs_r = []
 
-    # time_total = 0
-    # num_total = 0
-    for iter_num in range(0, iters):
-        start = iter_num * args.len
-        env.reset_for_test(nums, start)
-        f1_r.append(sum(env.schedule_curr_sequence_reset(env.f1_score).values()))
-        # f2_r.append(sum(env.schedule_curr_sequence_reset(env.f2_score).values()))
-        uni_r.append(sum(env.schedule_curr_sequence_reset(env.uni_score).values()))
-        wfp_r.append(sum(env.schedule_curr_sequence_reset(env.wfp_score).values()))
-
-        sjf_r.append(sum(env.schedule_curr_sequence_reset(env.sjf_score).values()))
-        # small_r.append(sum(env.schedule_curr_sequence_reset(env.smallest_score).values()))
-        fcfs_r.append(sum(env.schedule_curr_sequence_reset(env.fcfs_score).values()))
-
-        o = env.build_observation()
-        rl = 0
-        total_decisions = 0
-        rl_decisions = 0
-        while True:
-            count = 0
-            skip_ = []
-            lst = []
-            for i in range(0, MAX_QUEUE_SIZE * JOB_FEATURES, JOB_FEATURES):
-                if all(o[i:i + JOB_FEATURES] == [0] + [1] * (JOB_FEATURES - 2) + [0]):
-                    lst.append(0)
-                elif all(o[i:i + JOB_FEATURES] == [1] * JOB_FEATURES):
-                    lst.append(0)
-                else:
-                    count += 1
-                    if all(o[i:i + JOB_FEATURES] == [1] * (JOB_FEATURES - 1) + [0]):
-                        skip_.append(math.floor(i / JOB_FEATURES))
-                    lst.append(1)
-
-            out = get_out(o, np.array(lst))
-            softmax_out = tf.nn.softmax(out)
-            confidence = tf.reduce_max(softmax_out)
-            total_decisions += 1.0
-            if confidence > 0:
-                # start_time = time.time()
-                pi = get_probs(o, np.array(lst))
-                # pi = tf.arg_max(softmax_out, dimension=1)
-                # time_total += time.time() - start_time
-                # num_total += 1
-                # print(start_time, time_total, num_total)
-                a = pi[0]
-                rl_decisions += 1.0
-            else:
-                # print('SJF')
-                a = action_from_obs(o)
-            # print(out)
-            # v_t = get_value(o)
-
-
-            o, r, d, _ = env.step_for_test(a)
-            rl += r
-            if d:
-                # print("RL decision ratio:",rl_decisions/total_decisions)
-                break
-        rl_r.append(rl)
+    for env in envs:
+        f1_r.append(env.baseline_score(env.f1_score))
+        # f2_r.append(env.baseline_score(env.f2_score))
+        uni_r.append(env.baseline_score(env.uni_score))
+        wfp_r.append(env.baseline_score(env.wfp_score))
+
+        sjf_r.append(env.baseline_score(env.sjf_score))
+        # small_r.append(env.baseline_score(env.smallest_score))
+        fcfs_r.append(env.baseline_score(env.fcfs_score))
+
+    # all the sequences are scheduled together, with one forward pass per decision for all of them
+    if greedy:
+        get_actions = lambda o, mask: np.argmax(get_out(o, mask), axis=1)
+    else:
+        get_actions = get_probs
+    rewards, decisions = run_test_sequences(envs, get_actions)
+    rl_r.extend(rewards)
 
     # plot
     all_data = []
@@ -146,6 +106,7 @@ def run_policy(env, get_probs, get_out, nums, iters, score_type):
     for p in all_data:
         all_means.append(np.mean(p))
     print(*all_means)
+    return all_means
 
 
 
@@ -164,6 +125,9 @@ if __name__ == '__main__':
     parser.add_argument('--skip', type=int, default=0)
     parser.add_argument('--score_type', type=int, default=0)
     parser.add_argument('--batch_job_slice', type=int, default=0)
+    parser.add_argument('--greedy', type=int, default=0)  # pick the most likely action instead of sampling it
+    parser.add_argument('--cluster', type=str, default='simple', choices=sorted(CLUSTERS))  # node: place jobs on nodes
+    parser.add_argument('--cluster_policy', type=str, default='first_fit', choices=POLICIES)  # of the node cluster
 
     args = parser.parse_args()
 
@@ -173,12 +137,11 @@ if __name__ == '__main__':
 
     get_probs, get_value = load_policy(model_file, 'last')
 
-    # initialize the environment from scratch
-    env = HPCEnv(shuffle=args.shuffle, backfil=args.backfil, skip=args.skip, job_score_type=args.score_type,
-                 batch_job_slice=args.batch_job_slice, build_sjf=False)
-    env.my_init(workload_file=workload_file)
-    env.seed(args.seed)
+    # one environment per test sequence, all evaluated together
+    envs = test_envs(workload_file, args.iter, args.len, seed=args.seed, shuffle=args.shuffle, backfil=args.backfil,
+                     skip=args.skip, job_score_type=args.score_type, batch_job_slice=args.batch_job_slice,
+                     build_sjf=False, cluster=args.cluster, cluster_policy=args.cluster_policy)
 
     start = time.time()
-    run_policy(env, get_probs, get_value, args.len, args.iter, args.score_type)
+    run_policy(envs, get_probs, get_value, args.greedy, args.score_type)
     print("elapse: {}".format(time.time() - start))
\ No newline at end of file
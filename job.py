@@ -1,6 +1,31 @@
 import re
+import os
 import sys
 import math
+import json
+import shutil
+import hashlib
+import warnings
+import time
+
+import numpy as np
+
+# the 18 standard SWF fields, in file order. These are also the columns of the Workloads store.
+SWF_FIELDS = ["job_id", "submit_time", "wait_time", "run_time", "number_of_allocated_processors",
+              "average_cpu_time_used", "used_memory", "request_number_of_processors", "request_time",
+              "request_memory", "status", "user_id", "group_id", "executable_number", "queue_number",
+              "partition_number", "proceeding_job_number", "think_time_from_proceeding_job"]
+SWF_FLOAT_FIELDS = ["average_cpu_time_used"]
+
+# bump this whenever the layout or the parsing rules of the cached columns change.
+CACHE_VERSION = 1
+CACHE_STATS = ["max", "max_exec_time", "min_exec_time", "max_requested_memory", "max_user_id",
+               "max_group_id", "max_executable_number", "max_nodes", "max_procs"]
+
+# lines parsed at a time: parsing a trace needs memory for one chunk of it, not for the whole trace.
+SWF_CHUNK_SIZE = 100000
+# Job objects a Workloads keeps, see Workloads.__getitem__.
+MAX_CACHED_JOBS = 1 << 16
 
 
 class Job:
@@ -25,7 +50,13 @@ class Job:
     16. Partition Number -- a natural number, between one and the number of different partitions in the systems. The nature of the system's partitions should be explained in a header comment. For example, it is possible to use partition numbers to identify which machine in a cluster was used.
     17. Preceding Job Number -- this is the number of a previous job in the workload, such that the current job can only start after the termination of this preceding job. Together with the next field, this allows the workload to include feedback as described below.
     18. Think Time from Preceding Job -- this is the number of seconds that should elapse between the termination of the preceding job and the submittal of this one.
+
+    The attributes are slots rather than a __dict__: a job takes a quarter of the memory and they are faster to read.
     """
+    __slots__ = SWF_FIELDS + ["request_number_of_nodes", "random_id", "scheduled_time", "trace_idx",
+                              "allocated_machines", "slurm_in_queue_time", "slurm_age", "slurm_job_size",
+                              "slurm_fair", "slurm_partition", "slurm_qos", "slurm_tres_cpu"]
+
     def __init__(self, line = "0        0      0    0   0     0    0   0  0 0  0   0   0  0  0 0 0 0"):
         line = line.strip()
         s_array = re.split("\\s+", line)
@@ -74,9 +105,24 @@ class Job:
         self.proceeding_job_number = int(s_array[16])
         self.think_time_from_proceeding_job = int(s_array[17])
 
+        self.init_state()
+
+    @classmethod
+    def from_fields(cls, values):
+        # build a job from already parsed (and fixed up) SWF field values, ordered as SWF_FIELDS
+        job = cls.__new__(cls)
+        for name, value in zip(SWF_FIELDS, values):
+            setattr(job, name, value)
+        job.request_number_of_nodes = -1
+        job.init_state()
+        return job
+
+    def init_state(self):
         self.random_id = self.submit_time
 
         self.scheduled_time = -1
+        # position of the job in its Workloads, -1 for jobs that are not part of a trace
+        self.trace_idx = -1
 
         self.allocated_machines = None
 
@@ -88,6 +134,42 @@ class Job:
         self.slurm_qos = 0
         self.slurm_tres_cpu = 0.0
         
+    def copy(self):
+        # attribute by attribute, about five times faster than a loop over __slots__: the jobs of every simulated
+        # sequence are copied (see HPCEnv.job). Keep it in line with __slots__.
+        job = Job.__new__(Job)
+        job.job_id = self.job_id
+        job.submit_time = self.submit_time
+        job.wait_time = self.wait_time
+        job.run_time = self.run_time
+        job.number_of_allocated_processors = self.number_of_allocated_processors
+        job.average_cpu_time_used = self.average_cpu_time_used
+        job.used_memory = self.used_memory
+        job.request_number_of_processors = self.request_number_of_processors
+        job.request_time = self.request_time
+        job.request_memory = self.request_memory
+        job.status = self.status
+        job.user_id = self.user_id
+        job.group_id = self.group_id
+        job.executable_number = self.executable_number
+        job.queue_number = self.queue_number
+        job.partition_number = self.partition_number
+        job.proceeding_job_number = self.proceeding_job_number
+        job.think_time_from_proceeding_job = self.think_time_from_proceeding_job
+        job.request_number_of_nodes = self.request_number_of_nodes
+        job.random_id = self.random_id
+        job.scheduled_time = self.scheduled_time
+        job.trace_idx = self.trace_idx
+        job.allocated_machines = self.allocated_machines
+        job.slurm_in_queue_time = self.slurm_in_queue_time
+        job.slurm_age = self.slurm_age
+        job.slurm_job_size = self.slurm_job_size
+        job.slurm_fair = self.slurm_fair
+        job.slurm_partition = self.slurm_partition
+        job.slurm_qos = self.slurm_qos
+        job.slurm_tres_cpu = self.slurm_tres_cpu
+        return job
+
     def __eq__(self, other):
         return self.job_id == other.job_id
 
@@ -101,84 +183,346 @@ class Job:
                 self.user_id, self.group_id, self.executable_number, self.queue_number]
 
 
+def cache_dir(path):
+    return path + ".cache"
+
+
+def file_digest(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def load_cache(path):
+    """
+    Load the columns of a trace from its cache directory, memory-mapped and read-only, so that all
+    the processes working on the same trace share one copy through the page cache.
+    The cache is valid if the trace has the same size and mtime, or the same md5 when only its mtime changed.
+    Returns (None, None) if there is no valid cache.
+    """
+    directory = cache_dir(path)
+    meta_file = os.path.join(directory, "meta.json")
+    try:
+        with open(meta_file) as fp:
+            meta = json.load(fp)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None, None
+
+    if meta.get("version") != CACHE_VERSION or meta["size"] != stat.st_size:
+        return None, None
+    if meta["mtime"] != stat.st_mtime_ns:
+        if meta["md5"] != file_digest(path):
+            return None, None
+        # same content, just touched. Remember the new mtime so that we do not hash it again next time.
+        meta["mtime"] = stat.st_mtime_ns
+        try:
+            with open(meta_file, "w") as fp:
+                json.dump(meta, fp)
+        except OSError:
+            pass
+
+    try:
+        columns = {}
+        for name in SWF_FIELDS:
+            columns[name] = np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+    except (OSError, ValueError):
+        return None, None
+    return columns, meta
+
+
+def new_stats():
+    return dict(max=0, max_exec_time=0, min_exec_time=sys.maxsize, max_requested_memory=0, max_user_id=0,
+                max_group_id=0, max_executable_number=0, max_nodes=0, max_procs=0)
+
+
+def jobs_to_columns(jobs):
+    columns = {}
+    for name in SWF_FIELDS:
+        dtype = np.float64 if name in SWF_FLOAT_FIELDS else np.int64
+        columns[name] = np.array([getattr(job, name) for job in jobs], dtype=dtype)
+    return columns
+
+
+def parse_swf_lines(lines):
+    """
+    Convert SWF data lines to columns (ordered as SWF_FIELDS) in bulk, with the same values as Job(line):
+    the larger of the allocated and requested processors for both, the run time as request time when that is -1,
+    and partition 0 when it is not an integer. The text is converted to numbers in one call; only unusual lines
+    (see odd_lines) are parsed one by one with Job, which also raises on the invalid ones as before.
+    """
+    num_fields = len(SWF_FIELDS)
+    text = "".join(lines)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            values = np.fromstring(text, sep=" ")
+    except (ValueError, DeprecationWarning):
+        values = None
+    bulk = values is not None and values.size == len(lines) * num_fields
+    if not bulk or re.search(r"[^0-9+\-\s]", text):
+        # not only lines of plain integers: find the ones that are not just a fraction in a float field
+        odd = odd_lines(text, len(lines))
+        if odd.any():
+            plain = np.flatnonzero(~odd)
+            odd = np.flatnonzero(odd)
+            plain_columns = parse_swf_lines([lines[k] for k in plain])
+            odd_columns = jobs_to_columns([Job(lines[k]) for k in odd])
+            columns = {}
+            for name in SWF_FIELDS:
+                columns[name] = np.empty(len(lines), dtype=plain_columns[name].dtype)
+                columns[name][plain] = plain_columns[name]
+                columns[name][odd] = odd_columns[name]
+            return columns
+        if not bulk:
+            return jobs_to_columns([Job(line) for line in lines])
+
+    table = values.reshape(len(lines), num_fields)
+    columns = {}
+    for i, name in enumerate(SWF_FIELDS):
+        columns[name] = table[:, i].astype(np.float64 if name in SWF_FLOAT_FIELDS else np.int64)
+
+    processors = np.maximum(columns["number_of_allocated_processors"], columns["request_number_of_processors"])
+    columns["number_of_allocated_processors"] = processors
+    columns["request_number_of_processors"] = processors.copy()
+    columns["request_time"] = np.where(columns["request_time"] == -1, columns["run_time"], columns["request_time"])
+    return columns
+
+
+def odd_lines(text, num_lines):
+    """
+    Which of the num_lines lines of text do not have the SWF fields, or have anything but digits and signs outside
+    of SWF_FLOAT_FIELDS (a partition that is not an integer, an invalid number...), from the field each of its
+    characters is in, for all the lines at once.
+    """
+    data = np.frombuffer(text.encode(), dtype=np.uint8)
+    space = (data == ord(" ")) | ((data >= ord("\t")) & (data <= ord("\r")))
+    line_starts = np.concatenate([[0], np.flatnonzero(data == ord("\n")) + 1])[:num_lines]
+    start = ~space
+    start[1:] &= space[:-1]
+    starts = np.flatnonzero(start)    # of the fields
+    first_field = np.searchsorted(starts, line_starts)
+    num_fields = np.diff(np.append(first_field, len(starts)))
+    odd = num_fields != len(SWF_FIELDS)
+    # the characters that are not digits or signs, the line and the field of the line they are in
+    other = np.flatnonzero(~space & ((data < ord("0")) | (data > ord("9"))) & (data != ord("+")) & (data != ord("-")))
+    line = np.searchsorted(line_starts, other, side="right") - 1
+    field = np.searchsorted(starts, other, side="right") - 1 - first_field[line]
+    float_fields = [SWF_FIELDS.index(name) for name in SWF_FLOAT_FIELDS]
+    odd[line[~np.isin(field, float_fields)]] = True
+    return odd
+
+
+def filter_jobs(columns, stats):
+    # update the trace statistics with all the jobs, then keep the legal ones as Workloads does.
+    if len(columns["job_id"]):
+        stats["max_exec_time"] = max(stats["max_exec_time"], int(columns["run_time"].max()))
+        stats["min_exec_time"] = min(stats["min_exec_time"], int(columns["run_time"].min()))
+        for name, column in [("max_requested_memory", "request_memory"), ("max_user_id", "user_id"),
+                             ("max_group_id", "group_id"), ("max_executable_number", "executable_number")]:
+            stats[name] = max(stats[name], int(columns[column].max()))
+
+    # filter those illegal data whose runtime < 0
+    run_time = np.where(columns["run_time"] < 0, 10, columns["run_time"])
+    legal = run_time > 0
+    columns = {name: column[legal] for name, column in columns.items()}
+    columns["run_time"] = run_time[legal]
+    if len(columns["job_id"]):
+        stats["max"] = max(stats["max"], int(columns["request_number_of_processors"].max()))
+    return columns
+
+
+def iter_swf_chunks(path, stats, chunk_size=SWF_CHUNK_SIZE):
+    """
+    Parse an SWF trace chunk_size lines at a time, yielding the columns of the legal jobs of each chunk in file order.
+    The trace statistics (CACHE_STATS) are updated in stats as the chunks are read, and are final after the last one.
+    """
+    lines = []
+    with open(path) as fp:
+        for line in fp:
+            if line.startswith(";"):
+                if line.startswith("; MaxNodes:"):
+                    stats["max_nodes"] = int(line.split(":")[1].strip())
+                if line.startswith("; MaxProcs:"):
+                    stats["max_procs"] = int(line.split(":")[1].strip())
+                continue
+            lines.append(line)
+            if len(lines) == chunk_size:
+                yield filter_jobs(parse_swf_lines(lines), stats)
+                lines = []
+    if lines:
+        yield filter_jobs(parse_swf_lines(lines), stats)
+
+    # if max_procs = 0, it means node/proc are the same.
+    if stats["max_procs"] == 0:
+        stats["max_procs"] = stats["max_nodes"]
+
+
+def build_cache(path, chunk_size=SWF_CHUNK_SIZE):
+    """
+    Parse a trace straight into its cache directory, one chunk at a time, and load it as load_cache does.
+    The columns are appended to raw files and turned into .npy files at the end, then sorted by job id on disk
+    if the trace is not sorted already, so memory stays bounded by a chunk and a column index even for traces
+    larger than RAM. The trace statistics are kept in meta.json, so later loads never scan the trace again.
+    The cache is written into a private directory and renamed, so concurrent readers never see a partial cache.
+    Returns (None, None) if the cache can not be written.
+    """
+    directory = cache_dir(path)
+    tmp_directory = directory + ".tmp" + str(os.getpid())
+    dtypes = {name: np.dtype(np.float64 if name in SWF_FLOAT_FIELDS else np.int64) for name in SWF_FIELDS}
+    try:
+        os.makedirs(tmp_directory, exist_ok=True)
+        stats = new_stats()
+        num_jobs = 0
+        raw_files = {name: open(os.path.join(tmp_directory, name + ".raw"), "wb") for name in SWF_FIELDS}
+        try:
+            for chunk in iter_swf_chunks(path, stats, chunk_size):
+                for name in SWF_FIELDS:
+                    chunk[name].tofile(raw_files[name])
+                num_jobs += len(chunk["job_id"])
+        finally:
+            for fp in raw_files.values():
+                fp.close()
+
+        for name in SWF_FIELDS:
+            raw_file = os.path.join(tmp_directory, name + ".raw")
+            with open(raw_file, "rb") as src, open(os.path.join(tmp_directory, name + ".npy"), "wb") as dst:
+                np.lib.format.write_array_header_1_0(dst, {"descr": np.lib.format.dtype_to_descr(dtypes[name]),
+                                                           "fortran_order": False, "shape": (num_jobs,)})
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.remove(raw_file)
+
+        job_id = np.load(os.path.join(tmp_directory, "job_id.npy"), mmap_mode="r")
+        if np.any(job_id[1:] < job_id[:-1]):
+            order = np.argsort(job_id, kind="stable")
+            for name in SWF_FIELDS:
+                column = np.load(os.path.join(tmp_directory, name + ".npy"), mmap_mode="r+")
+                column[:] = column[order]
+                column.flush()
+                del column
+        del job_id
+
+        stat = os.stat(path)
+        meta = dict(stats, md5=file_digest(path), version=CACHE_VERSION, size=stat.st_size, mtime=stat.st_mtime_ns)
+        with open(os.path.join(tmp_directory, "meta.json"), "w") as fp:
+            json.dump(meta, fp)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory, ignore_errors=True)
+        os.rename(tmp_directory, directory)
+    except OSError as e:
+        print("Can not write the workload cache", directory, e)
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        return None, None
+    return load_cache(path)
+
+
 class Workloads:
+    """
+    A job trace stored column by column: self.columns maps every SWF field to one contiguous NumPy array,
+    holding the legal jobs sorted by job id. Job objects are only built for the jobs that are actually
+    accessed through self[idx], and only up to max_cached_jobs of them are kept. They are read only: a simulator
+    schedules copies of them (see HPCEnv.job), so a Workloads can be shared.
+    The parsed columns are cached next to the trace and memory-mapped (see build_cache and load_cache): only
+    the first load parses the SWF file, and the trace is never held in memory as a whole.
+    """
 
-    def __init__(self, path):
-        self.all_jobs = []
-        self.max = 0
-        self.max_exec_time = 0
-        self.min_exec_time = sys.maxsize
-        self.max_job_id = 0
+    def __init__(self, path, use_cache=True, max_cached_jobs=MAX_CACHED_JOBS):
+        self.path = path
+        columns, meta = None, None
+        if use_cache:
+            columns, meta = load_cache(path)
+            if columns is None:
+                columns, meta = build_cache(path)
+        if columns is None:
+            columns, meta = self.parse(path)
+            meta["md5"] = file_digest(path)
 
-        self.max_requested_memory = 0
-        self.max_user_id = 0
-        self.max_group_id = 0
-        self.max_executable_number = 0
+        self.columns = columns
+        # identifies the content of the trace, e.g. for results computed from it
+        self.digest = meta["md5"]
+        for name in CACHE_STATS:
+            setattr(self, name, meta[name])
         self.max_job_id = 0
-        self.max_nodes = 0
-        self.max_procs = 0
-
-        with open(path) as fp:
-            for line in fp:
-                if line.startswith(";"):
-                    if line.startswith("; MaxNodes:"):
-                        self.max_nodes = int(line.split(":")[1].strip())
-                    if line.startswith("; MaxProcs:"):
-                        self.max_procs = int(line.split(":")[1].strip())
-                    continue
-
-                j = Job(line)
-                if j.run_time > self.max_exec_time:
-                    self.max_exec_time = j.run_time
-                if j.run_time < self.min_exec_time:
-                    self.min_exec_time = j.run_time
-                if j.request_memory > self.max_requested_memory:
-                    self.max_requested_memory = j.request_memory
-                if j.user_id > self.max_user_id:
-                    self.max_user_id = j.user_id
-                if j.group_id > self.max_group_id:
-                    self.max_group_id = j.group_id
-                if j.executable_number > self.max_executable_number:
-                    self.max_executable_number = j.executable_number
-
-                # filter those illegal data whose runtime < 0
-                if j.run_time < 0:
-                    j.run_time = 10
-                if j.run_time > 0:
-                    self.all_jobs.append(j)
-                
-                    if j.request_number_of_processors > self.max:
-                        self.max = j.request_number_of_processors
-
-        # if max_procs = 0, it means node/proc are the same.
-        if self.max_procs == 0:
-            self.max_procs = self.max_nodes
+        self.jobs = {}
+        self.max_cached_jobs = max_cached_jobs
 
         print ("Max Allocated Processors:", str(self.max), ";max node:", self.max_nodes,
                ";max procs:", self.max_procs,
                ";max execution time:", self.max_exec_time)
 
-        self.all_jobs.sort(key=lambda job: job.job_id)
+    @staticmethod
+    def parse(path):
+        """
+        Parse an SWF trace into columns in memory. Returns the columns and the trace statistics (CACHE_STATS).
+        """
+        stats = new_stats()
+        chunks = list(iter_swf_chunks(path, stats)) or [jobs_to_columns([])]
+        columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in SWF_FIELDS}
+        order = np.argsort(columns["job_id"], kind="stable")
+        for name in SWF_FIELDS:
+            columns[name] = columns[name][order]
+        return columns, stats
 
     def size(self):
-        return len(self.all_jobs)
+        return len(self.columns["job_id"])
 
     def reset(self):
-        for job in self.all_jobs:
-            job.scheduled_time = -1
+        # deprecated: the jobs of a Workloads are never scheduled (see HPCEnv.job), so there is nothing to reset, and
+        # the cached Job objects are dropped in __getitem__. Kept for the callers of the old API.
+        warnings.warn("Workloads.reset is deprecated and does nothing: HPCEnv schedules copies of the jobs",
+                      DeprecationWarning, stacklevel=2)
 
     def __getitem__(self, item):
-        return self.all_jobs[item]
+        if item < 0:
+            item += self.size()
+        job = self.jobs.get(item)
+        if job is None:
+            # the jobs built so far are dropped once there are too many of them: they are rebuilt from the columns
+            # when needed, and memory stays bounded by the windows being simulated, not by the trace.
+            if len(self.jobs) >= self.max_cached_jobs:
+                self.jobs = {}
+            job = Job.from_fields([self.columns[name][item].item() for name in SWF_FIELDS])
+            job.trace_idx = item
+            self.jobs[item] = job
+        return job
 
 
 if __name__ == "__main__":
-    print ("Loading the workloads...")
-    load = Workloads("../../../data/lublin_256.swf")
-    print ("Finish loading the workloads...", type(load[0]))
-    print (load.max_nodes, load.max_procs)
-    print (load[0].__feature__())
-    print (load[1].__feature__())
-    
-    # empty_job_str = "0        0      0    0   0     0    0   0  0 0  0   0   0  0  0 0 0 0"
-    # empty_job = Job(empty_job_str)
-    # print (empty_job.job_id, empty_job.feature())
\ No newline at end of file
+    # check that the bulk parser gives the same jobs and statistics as parsing the trace line by line with Job
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workload', type=str, default='./data/lublin_256.swf')
+    args = parser.parse_args()
+
+    stats = new_stats()
+    jobs = []
+    with open(args.workload) as fp:
+        for line in fp:
+            if line.startswith(";"):
+                continue
+            j = Job(line)
+            stats["max_exec_time"] = max(stats["max_exec_time"], j.run_time)
+            stats["min_exec_time"] = min(stats["min_exec_time"], j.run_time)
+            stats["max_requested_memory"] = max(stats["max_requested_memory"], j.request_memory)
+            stats["max_user_id"] = max(stats["max_user_id"], j.user_id)
+            stats["max_group_id"] = max(stats["max_group_id"], j.group_id)
+            stats["max_executable_number"] = max(stats["max_executable_number"], j.executable_number)
+            if j.run_time < 0:
+                j.run_time = 10
+            if j.run_time > 0:
+                jobs.append(j)
+                stats["max"] = max(stats["max"], j.request_number_of_processors)
+    expected = jobs_to_columns(sorted(jobs, key=lambda job: job.job_id))
+
+    start = time.time()
+    columns, parsed_stats = Workloads.parse(args.workload)
+    print ("Parsed", len(columns["job_id"]), "jobs in", time.time() - start, "seconds")
+    for name in SWF_FIELDS:
+        assert columns[name].dtype == expected[name].dtype and np.array_equal(columns[name], expected[name]), name
+    for name in stats:
+        if name not in ["max_nodes", "max_procs"]:
+            assert parsed_stats[name] == stats[name], name
+    print ("Same jobs and statistics as Job(line)")
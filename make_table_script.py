@@ -1,13 +1,74 @@
+"""
+Regenerate the tables of the paper: every (backfilling, model, workload) cell is evaluated with
+compare-make-table.py, in process. The cells run on a pool of worker processes, each keeping one TF session per
+model it has loaded; the column caches of the workloads are built once beforehand and then shared (memory-mapped)
+by all the workers. The table is printed and written to <output>.csv and <output>.json; the cells that can not
+be evaluated (their trace or model is missing) are left out of it and reported.
+"""
 import os
+import csv
+import json
+import time
+import importlib
+import multiprocessing
+
+from job import Workloads
 
 batches = [0, 10000, 10000, 0]
-len = 1024
-iter = 10
+len_seq = 1024
+num_iter = 10
+POLICIES = ["FCFS", "WFP3", "UNI", "SJF", "F1", "RL"]
+
+# compare-make-table.py and the policies loaded by a worker process, by model path
+compare = None
+policies = {}
+
+
+def init_worker():
+    global compare
+    compare = importlib.import_module("compare-make-table")
+
+
+def run_cell(cell):
+    model_path = cell["model_path"]
+    if model_path not in policies:
+        # each model in its own graph, so that the saved graphs of different models do not clash
+        with compare.tf.Graph().as_default():
+            policies[model_path] = compare.load_policy(model_path, 'last')
+    get_probs, get_out = policies[model_path]
+
+    envs = compare.test_envs(cell["workload"], num_iter, len_seq, seed=cell["seed"], backfil=cell["backfil"],
+                             job_score_type=cell["score_type"], batch_job_slice=cell["batch_job_slice"],
+                             build_sjf=False)
+    means = compare.run_policy(envs, get_probs, get_out, 0, cell["score_type"])
+    row = dict(cell)
+    row.update(zip(POLICIES, [float(m) for m in means]))
+    return row
+
+
+def write_table(rows, output):
+    columns = ["backfil", "model", "workload"] + POLICIES
+    with open(output + ".csv", "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(output + ".json", "w") as fp:
+        json.dump(rows, fp, indent=2)
+
+    print("| Trace | " + " | ".join(POLICIES) + " |")
+    for backfil in [0, 1]:
+        print("| With backfilling |" if backfil else "| Without backfilling |")
+        for row in rows:
+            if row["backfil"] == backfil:
+                print("| " + row["model"] + " | " + " | ".join("%.3f" % row[p] for p in POLICIES) + " |")
+
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--score_type', type=str, default="bsld")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--output', type=str, default='')  # default: table_<score_type>
     args = parser.parse_args()
     if args.score_type == "bsld":
         dire = "trained_models/bsld/"
@@ -26,14 +87,41 @@ if __name__ == '__main__':
     else:
         raise NotImplementedError
 
+    start = time.time()
+    current_dir = os.getcwd()
+
+    # parse every trace once, here, so that the workers only load its column cache. A trace that can not be
+    # loaded (or a model that is missing) only fails its own cells, they are reported after the table.
+    errors = {}
+    for workload in workloads:
+        try:
+            Workloads(os.path.join(current_dir, workload))
+        except (OSError, ValueError, IndexError) as e:
+            errors[workload] = "can not load {}: {!r}".format(workload, e)
+
+    cells = []
+    failed = []
     for backfil in [0, 1]:
         for model, workload, batch_job_slice in zip(models, workloads, batches):
-            print("*"*20+model+"_seed_"+str(seed)+"*"*20)
-            sub_file = os.listdir(dire+"/"+model)[-1]
-            command = "--rlmodel {6}{0}/{8}/ --seed {1} --len {2} --backfil {3} --score_type {4} --batch_job_slice {5} --workload {7} --iter {9}"\
-                .format(model, seed, len, backfil, score_type, batch_job_slice, dire, workload, sub_file, iter)
-            print(command)
-            s = os.popen("python"+ " -W ignore compare-make-table.py " + command).read()
-
-            print(s)
-            print("*"*50)
+            cell = {"backfil": backfil, "model": model, "workload": os.path.join(current_dir, workload),
+                    "batch_job_slice": batch_job_slice, "score_type": score_type, "seed": seed}
+            try:
+                sub_file = os.listdir(dire + "/" + model)[-1]
+            except (OSError, IndexError) as e:
+                errors.setdefault(model, "can not find model {}: {!r}".format(model, e))
+            if workload in errors or model in errors:
+                failed.append((cell, errors.get(workload) or errors[model]))
+                continue
+            cell["model_path"] = os.path.join(current_dir, dire, model, sub_file)
+            cells.append(cell)
+
+    rows = []
+    if cells:
+        # spawned workers: TensorFlow must not be inherited through fork
+        with multiprocessing.get_context("spawn").Pool(min(args.workers, len(cells)), initializer=init_worker) as pool:
+            rows = pool.map(run_cell, cells)
+
+    write_table(rows, args.output or "table_" + args.score_type)
+    for cell, error in failed:
+        print("failed cell (backfil {}, {}): {}".format(cell["backfil"], cell["model"], error))
+    print("elapse: {}".format(time.time() - start))
@@ -10,6 +10,13 @@ from spinup.utils.mpi_tools import mpi_fork, mpi_avg, proc_id, mpi_statistics_sc
 from spinup.utils.logx import restore_tf_graph
 import os.path as osp
 from HPCSimPickJobs import *
+import queue
+import multiprocessing
+from vec_env import VecHPCEnv, SubprocVecHPCEnv, actor_loop, get_trajectory, stop_actors
+from cluster import CLUSTERS, POLICIES
+
+BUFFER_CHUNK_SIZE = 4096  # steps the experience buffer grows by
+IS_TRUNCATION = 2.0  # importance weights of the steps of stale trajectories are truncated at this value
 def load_policy(model_path, itr='last'):
     # handle which epoch to load from
     if itr=='last':
@@ -141,15 +148,21 @@ class PPOBuffer:
     A buffer for storing trajectories experienced by a PPO agent interacting
     with the environment, and using Generalized Advantage Estimation (GAE-Lambda)
     for calculating the advantages of state-action pairs.
+
+    The buffer grows with the trajectories stored: observations and masks are kept in chunks of size steps,
+    allocated as they are needed, and the per-step scalars in arrays doubled when full. Observations are stored
+    as obs_dtype: float32, float16, or uint8 (every feature is in [0, 1], quantized to 1/255); masks as bits.
+    get leaves them so, they are decoded to float32 a minibatch at a time as they are fed (see EncodedSteps).
     """
 
-    def __init__(self, obs_dim, act_dim, size, gamma=0.99, lam=0.95):
-        size = size * 100 # assume the traj can be really long
-        self.obs_buf = np.zeros(combined_shape(size, obs_dim), dtype=np.float32)
+    def __init__(self, obs_dim, act_dim, size, gamma=0.99, lam=0.95, obs_dtype='float32'):
+        self.obs_dim, self.chunk_size = obs_dim, size
+        self.obs_dtype = np.dtype(obs_dtype)
+        self.obs_chunks, self.mask_chunks = [], []
        # self.cobs_buf = np.zeros(combined_shape(size, JOB_SEQUENCE_SIZE*3), dtype=np.float32)
         self.cobs_buf = None
-        self.act_buf = np.zeros(combined_shape(size, act_dim), dtype=np.float32)
-        self.mask_buf = np.zeros(combined_shape(size, MAX_QUEUE_SIZE), dtype=np.float32)
+        # discrete actions are indices
+        self.act_buf = np.zeros(combined_shape(size, act_dim), dtype=np.int32 if act_dim == () else np.float32)
         self.adv_buf = np.zeros(size, dtype=np.float32)
         self.rew_buf = np.zeros(size, dtype=np.float32)
         self.ret_buf = np.zeros(size, dtype=np.float32)
@@ -158,15 +171,30 @@ class PPOBuffer:
         self.gamma, self.lam = gamma, lam
         self.ptr, self.path_start_idx, self.max_size = 0, 0, size
 
+    def grow(self):
+        # double the per-step arrays
+        for name in ["act_buf", "adv_buf", "rew_buf", "ret_buf", "val_buf", "logp_buf"]:
+            buf = getattr(self, name)
+            setattr(self, name, np.concatenate([buf, np.zeros_like(buf)]))
+        self.max_size *= 2
+
     def store(self, obs, cobs, act, mask, rew, val, logp):
         """
         Append one timestep of agent-environment interaction to the buffer.
         """
-        assert self.ptr < self.max_size     # buffer has to have room so you can store
-        self.obs_buf[self.ptr] = obs
+        if self.ptr == self.max_size:
+            self.grow()
+        chunk, i = divmod(self.ptr, self.chunk_size)
+        if chunk == len(self.obs_chunks):
+            self.obs_chunks.append(np.zeros(combined_shape(self.chunk_size, self.obs_dim), dtype=self.obs_dtype))
+            self.mask_chunks.append(np.zeros((self.chunk_size, (MAX_QUEUE_SIZE + 7) // 8), dtype=np.uint8))
+        if self.obs_dtype == np.uint8:
+            self.obs_chunks[chunk][i] = np.rint(np.asarray(obs) * 255)
+        else:
+            self.obs_chunks[chunk][i] = obs
        # self.cobs_buf[self.ptr] = cobs
         self.act_buf[self.ptr] = act
-        self.mask_buf[self.ptr] = mask
+        self.mask_chunks[chunk][i] = np.packbits(np.asarray(mask) != 0)
         self.rew_buf[self.ptr] = rew
         self.val_buf[self.ptr] = val
         self.logp_buf[self.ptr] = logp
@@ -207,12 +235,10 @@ class PPOBuffer:
         the buffer, with advantages appropriately normalized (shifted to have
         mean zero and std one). Also, resets some pointers in the buffer.
         """
-        assert self.ptr < self.max_size
         actual_size = self.ptr
         self.ptr, self.path_start_idx = 0, 0
 
-        actual_adv_buf = np.array(self.adv_buf, dtype = np.float32)
-        actual_adv_buf = actual_adv_buf[:actual_size]
+        actual_adv_buf = np.array(self.adv_buf[:actual_size], dtype = np.float32)
         # print ("-----------------------> actual_adv_buf: ", actual_adv_buf)
         adv_sum = np.sum(actual_adv_buf)
         adv_n = len(actual_adv_buf)
@@ -223,9 +249,87 @@ class PPOBuffer:
         actual_adv_buf = (actual_adv_buf - adv_mean) / adv_std
         # print (actual_adv_buf)
 
-        return [self.obs_buf[:actual_size],  self.act_buf[:actual_size], self.mask_buf[:actual_size], actual_adv_buf,
+        # chunks this epoch did not need are freed, the others are read as they are until the next store
+        num_chunks = -(-actual_size // self.chunk_size)
+        del self.obs_chunks[num_chunks:], self.mask_chunks[num_chunks:]
+        obs_buf = EncodedSteps(self.obs_chunks, self.chunk_size, actual_size, self.decode_obs)
+        mask_buf = EncodedSteps(self.mask_chunks, self.chunk_size, actual_size, self.decode_mask)
+
+        return [obs_buf, self.act_buf[:actual_size], mask_buf, actual_adv_buf,
                 self.ret_buf[:actual_size], self.logp_buf[:actual_size]]
 
+    def decode_obs(self, rows):
+        if self.obs_dtype == np.uint8:
+            return rows.astype(np.float32) / 255
+        return rows.astype(np.float32)
+
+    @staticmethod
+    def decode_mask(rows):
+        return np.unpackbits(rows, axis=1)[:, :MAX_QUEUE_SIZE].astype(np.float32)
+
+
+class EncodedSteps:
+    """
+    The observations or the masks of the steps of a PPOBuffer, as they are stored (chunks of rows), decoded to float32
+    only for the rows indexed: steps[idx] for a minibatch, steps[:] for all of them.
+    """
+    def __init__(self, chunks, chunk_size, num_steps, decode):
+        self.chunks, self.chunk_size, self.num_steps, self.decode = chunks, chunk_size, num_steps, decode
+
+    def __len__(self):
+        return self.num_steps
+
+    def __getitem__(self, idx):
+        chunk, row = np.divmod(np.arange(self.num_steps)[idx], self.chunk_size)
+        rows = None
+        for c in np.unique(chunk):
+            in_chunk = chunk == c
+            decoded = self.decode(self.chunks[c][row[in_chunk]])
+            if rows is None:
+                rows = np.empty((len(chunk),) + decoded.shape[1:], dtype=np.float32)
+            rows[in_chunk] = decoded
+        return rows
+
+def policy_variables():
+    # the variables of the policy and value networks, in the same order in every process building them
+    return [var for var in tf.trainable_variables() if var.name.startswith(('pi/', 'v/'))]
+
+
+def actor_worker(actor_id, workload_file, seed, num_envs, env_kwargs, ac_kwargs, param_queue, traj_queue):
+    """
+    An actor of the pipelined mode of ppo (actors > 0): runs vec_env.actor_loop on num_envs environments with its
+    own copy of the policy. The learner sends its parameters on param_queue as (version, values) after every update.
+    """
+    tf.set_random_seed(seed + actor_id)
+    venv = VecHPCEnv(workload_file, num_envs, seed=seed + actor_id * num_envs, **env_kwargs)
+    x_ph, a_ph = placeholders_from_spaces(venv.observation_space, venv.action_space)
+    mask_ph = placeholder(MAX_QUEUE_SIZE)
+    pi, logp, logp_pi, v, out = actor_critic(x_ph, a_ph, mask_ph, **ac_kwargs)
+    # the learner uses the other cores
+    sess = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1))
+    variables = policy_variables()
+
+    version = -1
+    def load_params(block):
+        nonlocal version
+        params = param_queue.get() if block else None
+        while True:
+            try:
+                params = param_queue.get_nowait()
+            except queue.Empty:
+                break
+        if params is not None:
+            version = params[0]
+            for var, value in zip(variables, params[1]):
+                var.load(value, sess)
+        return version
+
+    def policy(obs, masks):
+        return sess.run([pi, v, logp_pi], feed_dict={x_ph: obs, mask_ph: masks})
+
+    actor_loop(venv, policy, load_params, traj_queue)
+
+
 """
 
 Proximal Policy Optimization (by clipping), 
@@ -237,7 +341,8 @@ def ppo(workload_file, model_path, ac_kwargs=dict(), seed=0,
         traj_per_epoch=4000, epochs=50, gamma=0.99, clip_ratio=0.2, pi_lr=3e-4,
         vf_lr=1e-3, train_pi_iters=80, train_v_iters=80, lam=0.97, max_ep_len=1000,
         target_kl=0.01, logger_kwargs=dict(), save_freq=10,pre_trained=0,trained_model=None,attn=False,shuffle=False,
-        backfil=False, skip=False, score_type=0, batch_job_slice=0):
+        backfil=False, skip=False, score_type=0, batch_job_slice=0, num_envs=1, env_workers=0, obs_dtype='float32',
+        minibatch_size=0, train_passes=10, actors=0, actor_queue=0, cluster="simple", cluster_policy="first_fit"):
 
     logger = EpochLogger(**logger_kwargs)
     logger.save_config(locals())
@@ -245,20 +350,31 @@ def ppo(workload_file, model_path, ac_kwargs=dict(), seed=0,
     tf.set_random_seed(seed)
     np.random.seed(seed)
 
-    env = HPCEnv(shuffle=shuffle, backfil=backfil, skip=skip, job_score_type=score_type, batch_job_slice=batch_job_slice, build_sjf=False)
-    env.seed(seed)
-    env.my_init(workload_file=workload_file, sched_file=model_path)
-    
-    obs_dim = env.observation_space.shape
-    act_dim = env.action_space.shape
+    # num_envs environments (seeded seed, seed+1, ...) are stepped together, their actions are sampled in one batch.
+    # with env_workers > 0 they are simulated in that many worker processes instead of this one.
+    env_kwargs = dict(shuffle=shuffle, backfil=backfil, skip=skip, job_score_type=score_type,
+                      batch_job_slice=batch_job_slice, build_sjf=False, cluster=cluster, cluster_policy=cluster_policy)
+    # with actors > 0, each of that many actor processes steps num_envs environments of its own (see actor_worker)
+    if actors > 0:
+        venv = HPCEnv(**env_kwargs)  # only for the spaces
+        env = None
+    elif env_workers > 0:
+        venv = SubprocVecHPCEnv(workload_file, num_envs, seed=seed, num_workers=env_workers, **env_kwargs)
+        env = None
+    else:
+        venv = VecHPCEnv(workload_file, num_envs, seed=seed, **env_kwargs)
+        env = venv.envs[0]
+
+    obs_dim = venv.observation_space.shape
+    act_dim = venv.action_space.shape
     
     # Share information about action space with policy architecture
-    ac_kwargs['action_space'] = env.action_space
+    ac_kwargs['action_space'] = venv.action_space
     ac_kwargs['attn'] = attn
 
     # Inputs to computation graph
 
-    buf = PPOBuffer(obs_dim, act_dim, traj_per_epoch * JOB_SEQUENCE_SIZE, gamma, lam)
+    buf = PPOBuffer(obs_dim, act_dim, BUFFER_CHUNK_SIZE, gamma, lam, obs_dtype=obs_dtype)
 
     if pre_trained:
         sess = tf.Session()
@@ -308,7 +424,7 @@ def ppo(workload_file, model_path, ac_kwargs=dict(), seed=0,
         get_action_ops = [pi, v, logp_pi, out]
 
     else:
-        x_ph, a_ph = placeholders_from_spaces(env.observation_space, env.action_space)
+        x_ph, a_ph = placeholders_from_spaces(venv.observation_space, venv.action_space)
         # y_ph = placeholder(JOB_SEQUENCE_SIZE*3) # 3 is the number of sequence features
         mask_ph = placeholder(MAX_QUEUE_SIZE)
         adv_ph, ret_ph, logp_old_ph = placeholders(None, None, None)
@@ -353,84 +469,73 @@ def ppo(workload_file, model_path, ac_kwargs=dict(), seed=0,
     # logger.setup_tf_saver(sess, inputs={'x': x_ph}, outputs={'action_probs': action_probs, 'log_picked_action_prob': log_picked_action_prob, 'v': v})
     logger.setup_tf_saver(sess, inputs={'x': x_ph, 'a':a_ph, 'adv':adv_ph, 'mask':mask_ph, 'ret':ret_ph, 'logp_old_ph':logp_old_ph}, outputs={'pi': pi, 'v': v, 'out':out, 'pi_loss':pi_loss, 'logp': logp, 'logp_pi':logp_pi, 'v_loss':v_loss, 'approx_ent':approx_ent, 'approx_kl':approx_kl, 'clipped':clipped, 'clipfrac':clipfrac})
 
-    def update():
-        inputs = {k:v for k,v in zip(all_phs, buf.get())}
-        pi_l_old, v_l_old, ent = sess.run([pi_loss, v_loss, approx_ent], feed_dict=inputs)
+    def feeds(data, shuffle=False):
+        # the buffer as feed dicts of minibatch_size steps (shuffled if asked), or as one when minibatch_size is 0.
+        # only the rows of each minibatch are copied (and decoded, see EncodedSteps) in each step.
+        num_steps = len(data[0])
+        if minibatch_size <= 0 or minibatch_size >= num_steps:
+            yield {k: v for k, v in zip(all_phs, data)}, num_steps
+            return
+        order = np.random.permutation(num_steps) if shuffle else np.arange(num_steps)
+        for lo in range(0, num_steps, minibatch_size):
+            idx = order[lo:lo + minibatch_size]
+            yield {k: v[idx] for k, v in zip(all_phs, data)}, len(idx)
+
+    def run_mean(ops, data):
+        # the values of scalar mean ops over the whole buffer, computed minibatch by minibatch
+        total = np.zeros(len(ops))
+        for inputs, num in feeds(data):
+            total += num * np.array(sess.run(ops, feed_dict=inputs))
+        return total / len(data[0])
 
-        # Training
-        for i in range(train_pi_iters):
-            _, kl = sess.run([train_pi, approx_kl], feed_dict=inputs)
+    def update():
+        data = buf.get()
+        if minibatch_size <= 0 or minibatch_size >= len(data[0]):
+            # every step feeds the whole buffer: decode it once
+            data = [v[:] for v in data]
+        if actors > 0:
+            # the trajectories come from policies a few updates old. The steps are clipped against the current
+            # policy instead, and weighted by its probability over the one of the actor (truncated importance
+            # sampling), as in decoupled PPO. The weights multiply the advantages, as they are non-negative.
+            # With obs_dtype float16 or uint8, the weights also absorb the quantization of the observations: the
+            # actor picked the actions on the exact ones, the learner sees the stored ones.
+            logp_prox = np.concatenate([sess.run(logp, feed_dict=inputs) for inputs, _ in feeds(data)])
+            weight = np.minimum(np.exp(logp_prox - data[5]), IS_TRUNCATION)
+            data[3] = data[3] * weight
+            data[5] = logp_prox
+            logger.store(ISWeight=weight)
+        elif buf.obs_dtype != np.float32:
+            # the actions were picked on the exact observations, the learner sees the stored (quantized) ones: their
+            # logp under the same policy on those, so that the ratio is 1 before the first update step
+            data[5] = np.concatenate([sess.run(logp, feed_dict=inputs) for inputs, _ in feeds(data)])
+        pi_l_old, v_l_old, ent = run_mean([pi_loss, v_loss, approx_ent], data)
+
+        # Training: train_pi_iters and train_v_iters steps on the whole buffer, or, with minibatches,
+        # train_passes shuffled passes over it
+        pi_iters = train_passes if minibatch_size > 0 else train_pi_iters
+        v_iters = train_passes if minibatch_size > 0 else train_v_iters
+        for i in range(pi_iters):
+            kl = 0
+            for inputs, num in feeds(data, shuffle=True):
+                _, batch_kl = sess.run([train_pi, approx_kl], feed_dict=inputs)
+                kl += batch_kl * num / len(data[0])
             kl = mpi_avg(kl)
             if kl > 1.5 * target_kl:
                 logger.log('Early stopping at step %d due to reaching max kl.'%i)
                 break
         logger.store(StopIter=i)
-        for _ in range(train_v_iters):
-            sess.run(train_v, feed_dict=inputs)
+        for _ in range(v_iters):
+            for inputs, num in feeds(data, shuffle=True):
+                sess.run(train_v, feed_dict=inputs)
 
         # Log changes from update
-        pi_l_new, v_l_new, kl, cf = sess.run([pi_loss, v_loss, approx_kl, clipfrac], feed_dict=inputs)
+        pi_l_new, v_l_new, kl, cf = run_mean([pi_loss, v_loss, approx_kl, clipfrac], data)
         logger.store(LossPi=pi_l_old, LossV=v_l_old,
                      KL=kl, Entropy=ent, ClipFrac=cf,
                      DeltaLossPi=(pi_l_new - pi_l_old),
                      DeltaLossV=(v_l_new - v_l_old))
 
-    start_time = time.time()
-    [o, co], r, d, ep_ret, ep_len, show_ret, sjf, f1 = env.reset(), 0, False, 0, 0,0,0,0
-
-    # Main loop: collect experience in env and update/log each epoch
-    start_time = time.time()
-    num_total = 0
-    for epoch in range(epochs):
-        t = 0
-        while True:
-            lst = []
-            for i in range(0, MAX_QUEUE_SIZE * JOB_FEATURES, JOB_FEATURES):
-                if all(o[i:i+JOB_FEATURES] == [0]+[1]*(JOB_FEATURES-2)+[0]):
-                    lst.append(0)
-                elif all(o[i:i+JOB_FEATURES] == [1]*JOB_FEATURES):
-                    lst.append(0)
-                else:
-                    lst.append(1)
-
-            a, v_t, logp_t, output = sess.run(get_action_ops, feed_dict={x_ph: o.reshape(1,-1), mask_ph: np.array(lst).reshape(1,-1)})
-            # print(a, end=" ")
-
-            num_total += 1
-            '''
-            action = np.random.choice(np.arange(MAX_QUEUE_SIZE), p=action_probs)
-            log_action_prob = np.log(action_probs[action])
-            '''
-
-            # save and log
-            buf.store(o,None,  a, np.array(lst), r, v_t, logp_t)
-            logger.store(VVals=v_t)
-
-            o, r, d, r2, sjf_t, f1_t = env.step(a[0])
-            ep_ret += r
-            ep_len += 1
-            show_ret += r2
-            sjf += sjf_t
-            f1 += f1_t
-
-            if d:
-                t += 1
-                buf.finish_path(r)
-                logger.store(EpRet=ep_ret, EpLen=ep_len, ShowRet=show_ret, SJF=sjf, F1=f1)
-                [o, co], r, d, ep_ret, ep_len, show_ret, sjf, f1 = env.reset(), 0, False, 0, 0, 0, 0, 0
-                if t >= traj_per_epoch:
-                    # print ("state:", state, "\nlast action in a traj: action_probs:\n", action_probs, "\naction:", action)
-                    break
-        # print("Sample time:", (time.time()-start_time)/num_total, num_total)
-        # Save model
-        if (epoch % save_freq == 0) or (epoch == epochs-1):
-            logger.save_state({'env': env}, None)
-
-        # Perform PPO update!
-        # start_time = time.time()
-        update()
-        # print("Train time:", time.time()-start_time)
-
+    def log_epoch(epoch):
         # Log info about epoch
         logger.log_tabular('Epoch', epoch)
         logger.log_tabular('EpRet', with_min_and_max=True)
@@ -448,9 +553,116 @@ def ppo(workload_file, model_path, ac_kwargs=dict(), seed=0,
         logger.log_tabular('ShowRet', average_only=True)
         logger.log_tabular('SJF', average_only=True)
         logger.log_tabular('F1', average_only=True)
+        if actors > 0:
+            logger.log_tabular('PolicyLag', with_min_and_max=True)
+            logger.log_tabular('ISWeight', with_min_and_max=True)
         logger.log_tabular('Time', time.time()-start_time)
         logger.dump_tabular()
 
+    if actors > 0:
+        variables = policy_variables()
+        def publish(version):
+            values = sess.run(variables)
+            for param_queue in param_queues:
+                param_queue.put((version, values))
+
+        # spawned: the actors build their own TensorFlow graph and session
+        ctx = multiprocessing.get_context("spawn")
+        traj_queue = ctx.Queue(maxsize=actor_queue or traj_per_epoch)
+        param_queues = [ctx.Queue() for _ in range(actors)]
+        actor_processes = [ctx.Process(target=actor_worker, daemon=True,
+                                       args=(i, workload_file, seed, num_envs, env_kwargs, ac_kwargs,
+                                             param_queues[i], traj_queue))
+                           for i in range(actors)]
+        for p in actor_processes:
+            p.start()
+        publish(0)
+
+    # Main loop: collect experience in env and update/log each epoch
+    try:
+        start_time = time.time()
+        num_total = 0
+        for epoch in range(epochs):
+            if actors > 0:
+                # the trajectories come from the actors, which keep running while the learner trains
+                for _ in range(traj_per_epoch):
+                    version, steps, last_r, stats = get_trajectory(traj_queue, actor_processes)
+                    for step in steps:
+                        buf.store(step[0], None, *step[1:])
+                    buf.finish_path(last_r)
+                    ep_ret, ep_len, show_ret, sjf, f1 = stats
+                    logger.store(VVals=np.array([step[4] for step in steps]))
+                    logger.store(EpRet=ep_ret, EpLen=ep_len, ShowRet=show_ret, SJF=sjf, F1=f1, PolicyLag=epoch - version)
+                if (epoch % save_freq == 0) or (epoch == epochs-1):
+                    logger.save_state({'env': env}, None)
+                update()
+                publish(epoch + 1)
+                log_epoch(epoch)
+                continue
+
+            # exactly traj_per_epoch trajectories are started in each epoch; once they are all started,
+            # the environments that finish are left idle until the others are done.
+            active = list(range(min(num_envs, traj_per_epoch)))
+            num_started = len(active)
+            obs, masks = venv.reset(active)
+            # the steps of the trajectory running in each environment. A trajectory is only stored in the buffer
+            # when it is finished, so that each trajectory is contiguous in the buffer.
+            trajs = [[] for _ in range(num_envs)]
+            r = np.zeros(num_envs)
+            ep_ret, ep_len, show_ret, sjf, f1 = [np.zeros(num_envs) for _ in range(5)]
+            while active:
+                a, v_t, logp_t, output = sess.run(get_action_ops, feed_dict={x_ph: obs[active], mask_ph: masks[active]})
+                # print(a, end=" ")
+
+                num_total += len(active)
+                '''
+                action = np.random.choice(np.arange(MAX_QUEUE_SIZE), p=action_probs)
+                log_action_prob = np.log(action_probs[action])
+                '''
+
+                # save and log
+                for k, i in enumerate(active):
+                    trajs[i].append((obs[i].copy(), a[k], masks[i].copy(), r[i], v_t[k], logp_t[k]))
+                logger.store(VVals=v_t)
+
+                obs, masks, rews, dones, infos = venv.step(a, active)
+                r[active] = rews
+                ep_ret[active] += rews
+                ep_len[active] += 1
+                show_ret[active] += infos[:, 0]
+                sjf[active] += infos[:, 1]
+                f1[active] += infos[:, 2]
+
+                for i in [i for k, i in enumerate(active) if dones[k]]:
+                    for step in trajs[i]:
+                        buf.store(step[0], None, *step[1:])
+                    buf.finish_path(r[i])
+                    logger.store(EpRet=ep_ret[i], EpLen=ep_len[i], ShowRet=show_ret[i], SJF=sjf[i], F1=f1[i])
+                    trajs[i] = []
+                    r[i], ep_ret[i], ep_len[i], show_ret[i], sjf[i], f1[i] = 0, 0, 0, 0, 0, 0
+                    if num_started < traj_per_epoch:
+                        num_started += 1
+                        obs, masks = venv.reset([i])
+                    else:
+                        # print ("state:", state, "\nlast action in a traj: action_probs:\n", action_probs, "\naction:", action)
+                        active.remove(i)
+            # print("Sample time:", (time.time()-start_time)/num_total, num_total)
+            # Save model
+            if (epoch % save_freq == 0) or (epoch == epochs-1):
+                logger.save_state({'env': env}, None)
+
+            # Perform PPO update!
+            # start_time = time.time()
+            update()
+            # print("Train time:", time.time()-start_time)
+
+            log_epoch(epoch)
+    finally:
+        if actors > 0:
+            stop_actors(actor_processes, param_queues)
+        else:
+            venv.close()
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
@@ -470,6 +682,15 @@ if __name__ == '__main__':
     parser.add_argument('--skip', type=int, default=0)
     parser.add_argument('--score_type', type=int, default=0)
     parser.add_argument('--batch_job_slice', type=int, default=0)
+    parser.add_argument('--num_envs', type=int, default=1)
+    parser.add_argument('--env_workers', type=int, default=0)
+    parser.add_argument('--obs_dtype', type=str, default='float32')  # observations stored as float32, float16 or uint8
+    parser.add_argument('--minibatch_size', type=int, default=0)  # 0: every update step on the whole epoch
+    parser.add_argument('--train_passes', type=int, default=10)  # passes over the epoch with minibatches
+    parser.add_argument('--actors', type=int, default=0)  # actor processes generating trajectories asynchronously
+    parser.add_argument('--actor_queue', type=int, default=0)  # trajectories waiting for the learner, 0: --trajs
+    parser.add_argument('--cluster', type=str, default='simple', choices=sorted(CLUSTERS))  # node: place jobs on nodes
+    parser.add_argument('--cluster_policy', type=str, default='first_fit', choices=POLICIES)  # of the node cluster
     args = parser.parse_args()
 
     from spinup.utils.run_utils import setup_logger_kwargs
@@ -486,8 +707,13 @@ if __name__ == '__main__':
         ppo(workload_file, args.model, gamma=args.gamma, seed=args.seed, traj_per_epoch=args.trajs, epochs=args.epochs,
         logger_kwargs=logger_kwargs, pre_trained=1,trained_model=os.path.join(model_file,"simple_save"),attn=args.attn,
             shuffle=args.shuffle, backfil=args.backfil, skip=args.skip, score_type=args.score_type,
-            batch_job_slice=args.batch_job_slice)
+            batch_job_slice=args.batch_job_slice, num_envs=args.num_envs, env_workers=args.env_workers,
+            obs_dtype=args.obs_dtype, minibatch_size=args.minibatch_size, train_passes=args.train_passes,
+            actors=args.actors, actor_queue=args.actor_queue, cluster=args.cluster, cluster_policy=args.cluster_policy)
     else:
         ppo(workload_file, args.model, gamma=args.gamma, seed=args.seed, traj_per_epoch=args.trajs, epochs=args.epochs,
         logger_kwargs=logger_kwargs, pre_trained=0, attn=args.attn,shuffle=args.shuffle, backfil=args.backfil,
-            skip=args.skip, score_type=args.score_type, batch_job_slice=args.batch_job_slice)
+            skip=args.skip, score_type=args.score_type, batch_job_slice=args.batch_job_slice, num_envs=args.num_envs,
+            env_workers=args.env_workers, obs_dtype=args.obs_dtype, minibatch_size=args.minibatch_size,
+            train_passes=args.train_passes, actors=args.actors, actor_queue=args.actor_queue, cluster=args.cluster,
+            cluster_policy=args.cluster_policy)
@@ -0,0 +1,138 @@
+"""
+Precompute the SJF score of every sample sequence of a workload, used by HPCEnv(build_sjf=True) to filter the
+trajectories. Each score needs a full SJF schedule of the sequence, so the start indices are split into shards
+and scheduled on a process pool. Every finished shard is checkpointed, so an interrupted run resumes where it
+stopped. The final array is saved next to the workload, keyed by its md5 and the scheduler configuration:
+
+    python precompute_sjf.py --workload ./data/lublin_256.swf --backfil 0 --score_type 0 --workers 16
+"""
+import os
+import shutil
+import multiprocessing
+
+import numpy as np
+
+from job import Workloads
+from cluster import CLUSTERS, POLICIES, cluster_key
+from HPCSimPickJobs import HPCEnv, JOB_SEQUENCE_SIZE
+
+# the environment of a worker process, see init_worker
+env = None
+
+
+def sequence_range(num_jobs, batch_job_slice=0):
+    # the start indices HPCEnv.reset samples sequences from: [first, end)
+    if batch_job_slice == 0:
+        return JOB_SEQUENCE_SIZE, num_jobs - JOB_SEQUENCE_SIZE - 1
+    return JOB_SEQUENCE_SIZE, min(batch_job_slice, num_jobs) - JOB_SEQUENCE_SIZE - 1
+
+
+def scores_path(workload_file, digest, backfil, score_type, end, cluster="simple", cluster_policy="first_fit"):
+    name = "{}-len{}-backfil{}-score{}-{}-n{}".format(digest, JOB_SEQUENCE_SIZE, int(backfil), score_type,
+                                                     cluster_key(cluster, cluster_policy), end)
+    return os.path.join(workload_file + ".sjf", name)
+
+
+def save_atomic(path, array):
+    tmp_path = path + ".tmp" + str(os.getpid())
+    with open(tmp_path, "wb") as fp:
+        np.save(fp, array)
+    os.replace(tmp_path, path)
+
+
+def init_worker(workload_file, backfil, score_type, cluster, cluster_policy):
+    global env
+    env = HPCEnv(backfil=backfil, job_score_type=score_type, baseline_cache=False, cluster=cluster,
+                 cluster_policy=cluster_policy)
+    env.seed(0)
+    env.my_init(workload_file=workload_file)
+
+
+def compute_shard(shard):
+    lo, hi = shard
+    scores = np.empty(hi - lo)
+    for start in range(lo, hi):
+        env.reset_for_sequence(start)
+        scores[start - lo] = sum(env.schedule_curr_sequence_reset(env.sjf_score).values())
+    return lo, hi, scores
+
+
+def precompute_sjf_scores(workload_file, num_jobs, digest, backfil=False, score_type=0, batch_job_slice=0,
+                          workers=1, shard_size=100, cluster="simple", cluster_policy="first_fit"):
+    """
+    Returns an array with the SJF score of the sequence starting at each index (nan for the indices never sampled).
+    It is loaded if it was already computed, otherwise computed with workers processes, resuming from the
+    shards checkpointed by a previous run.
+    """
+    first, end = sequence_range(num_jobs, batch_job_slice)
+    path = scores_path(workload_file, digest, backfil, score_type, end, cluster, cluster_policy)
+    if os.path.exists(path + ".npy"):
+        return np.load(path + ".npy")
+
+    parts_dir = path + ".parts"
+    os.makedirs(parts_dir, exist_ok=True)
+    scores = np.full(max(end, 0), np.nan)
+    todo = []
+    for lo in range(first, end, shard_size):
+        hi = min(lo + shard_size, end)
+        part_file = os.path.join(parts_dir, "{}-{}.npy".format(lo, hi))
+        if os.path.exists(part_file):
+            scores[lo:hi] = np.load(part_file)
+        else:
+            todo.append((lo, hi))
+    print("SJF scores of sequences [{}, {}): {} shards to compute, {} already done".format(
+        first, end, len(todo), len(range(first, end, shard_size)) - len(todo)))
+
+    pool = None
+    if workers > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                    initargs=(workload_file, backfil, score_type, cluster, cluster_policy))
+        results = pool.imap_unordered(compute_shard, todo)
+    else:
+        init_worker(workload_file, backfil, score_type, cluster, cluster_policy)
+        results = map(compute_shard, todo)
+
+    for num_done, (lo, hi, part_scores) in enumerate(results, 1):
+        save_atomic(os.path.join(parts_dir, "{}-{}.npy".format(lo, hi)), part_scores)
+        scores[lo:hi] = part_scores
+        print("shard", num_done, "/", len(todo), "index", lo, "-", hi)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    save_atomic(path + ".npy", scores)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return scores
+
+
+def load_sjf_scores(workload_file, num_jobs, digest, backfil=False, score_type=0, batch_job_slice=0, cluster="simple",
+                    cluster_policy="first_fit"):
+    first, end = sequence_range(num_jobs, batch_job_slice)
+    path = scores_path(workload_file, digest, backfil, score_type, end, cluster, cluster_policy)
+    if not os.path.exists(path + ".npy"):
+        print("SJF scores not precomputed, computing them in this process. "
+              "Run precompute_sjf.py to compute them in parallel.")
+    return precompute_sjf_scores(workload_file, num_jobs, digest, backfil=backfil, score_type=score_type,
+                                 batch_job_slice=batch_job_slice, cluster=cluster, cluster_policy=cluster_policy)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workload', type=str, default='./data/lublin_256.swf')
+    parser.add_argument('--backfil', type=int, default=0)
+    parser.add_argument('--score_type', type=int, default=0)
+    parser.add_argument('--batch_job_slice', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--shard_size', type=int, default=100)
+    parser.add_argument('--cluster', type=str, default='simple', choices=sorted(CLUSTERS))
+    parser.add_argument('--cluster_policy', type=str, default='first_fit', choices=POLICIES)
+    args = parser.parse_args()
+
+    workload_file = os.path.join(os.getcwd(), args.workload)
+    loads = Workloads(workload_file)
+    precompute_sjf_scores(workload_file, loads.size(), loads.digest, backfil=args.backfil,
+                          score_type=args.score_type, batch_job_slice=args.batch_job_slice,
+                          workers=args.workers, shard_size=args.shard_size, cluster=args.cluster,
+                          cluster_policy=args.cluster_policy)
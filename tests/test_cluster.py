@@ -0,0 +1,171 @@
+"""
+The allocation policies of NodeCluster, its index of free runs (FreeBlocks) and fragmentation(), on hand-built free
+maps and against the free map after random allocate/release cycles, and its schedules against SimpleCluster.
+"""
+import os
+import random
+
+import numpy as np
+import pytest
+
+from cluster import FreeBlocks, NodeCluster, POLICIES, node_runs
+
+WORKLOAD = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "lublin_256.swf")
+
+# '.' a free node, '#' a busy one, 4 nodes per switch: free runs [1, 8), [9, 11) and [13, 14), and 3, 4, 2 and 1
+# free nodes on the switches
+FREE_MAP = "#... .... #..# #.##"
+
+
+def make_node_cluster(free_map, policy, nodes_per_switch=4):
+    free = np.array([c == "." for c in free_map.replace(" ", "")])
+    cluster = NodeCluster("Cluster", len(free), 1, policy="first_fit", nodes_per_switch=nodes_per_switch)
+    cluster.allocate(0, len(free))
+    cluster.release(np.flatnonzero(free))
+    cluster.policy = policy
+    return cluster
+
+
+def check_consistent(cluster):
+    free = cluster.free_map
+    assert not cluster.padded_map[cluster.total_node:].any()
+    assert np.count_nonzero(free) == cluster.free_node == cluster.total_node - cluster.used_node
+    assert np.array_equal(cluster.node_job == -1, free)
+    switch_free = np.bincount(np.flatnonzero(free) // cluster.nodes_per_switch, minlength=len(cluster.switch_free))
+    assert np.array_equal(cluster.switch_free, switch_free)
+    firsts, ends = node_runs(np.flatnonzero(free))
+    blocks = cluster.free_blocks
+    assert blocks.starts == firsts
+    assert blocks.lengths == {first: end - first for first, end in zip(firsts, ends)}
+    assert blocks.by_size == sorted((end - first, first) for first, end in zip(firsts, ends))
+
+
+@pytest.mark.parametrize("count, first_fit, best_fit, buddy, switch", [
+    (1, [1], [13], [13], [13]),
+    (2, [1, 2], [9, 10], [2, 3], [9, 10]),
+    (4, [1, 2, 3, 4], [1, 2, 3, 4], [4, 5, 6, 7], [4, 5, 6, 7]),
+    # no aligned run of 8 for buddy, nor a switch with 7 free nodes
+    (7, list(range(1, 8)), list(range(1, 8)), list(range(1, 8)), list(range(1, 8))),
+    (9, list(range(1, 8)) + [9, 10], list(range(1, 8)) + [9, 10], list(range(1, 8)) + [9, 10],
+     list(range(1, 8)) + [9, 10]),
+])
+def test_placement(count, first_fit, best_fit, buddy, switch):
+    expected = {"first_fit": first_fit, "best_fit": best_fit, "buddy": buddy, "switch": switch}
+    assert sorted(expected) == POLICIES
+    for policy, nodes in expected.items():
+        cluster = make_node_cluster(FREE_MAP, policy)
+        assert cluster.allocate(7, count).tolist() == nodes, policy
+        assert cluster.node_job[nodes].tolist() == [7] * count
+        check_consistent(cluster)
+
+
+def test_placement_fails():
+    cluster = make_node_cluster(FREE_MAP, "best_fit")
+    assert cluster.allocate(7, 11) == []
+    assert cluster.free_node == 10
+    check_consistent(cluster)
+
+
+def test_zero_nodes():
+    for policy in POLICIES:
+        cluster = make_node_cluster(FREE_MAP, policy)
+        nodes = cluster.allocate(7, 0)
+        assert len(nodes) == 0
+        cluster.release(nodes)
+        assert cluster.free_node == 10
+        check_consistent(cluster)
+
+
+def test_release_merges_runs():
+    cluster = NodeCluster("Cluster", 16, 1)
+    jobs = [cluster.allocate(job_id, 4) for job_id in range(4)]
+    assert len(cluster.free_blocks) == 0
+    cluster.release(jobs[1])
+    assert cluster.free_blocks.lengths == {4: 4}
+    cluster.release(jobs[3])
+    assert cluster.free_blocks.lengths == {4: 4, 12: 4}
+    # merged with the runs before and after
+    cluster.release(jobs[2])
+    assert cluster.free_blocks.lengths == {4: 12}
+    cluster.release(jobs[0])
+    assert cluster.free_blocks.lengths == {0: 16}
+    check_consistent(cluster)
+
+
+def test_free_blocks():
+    blocks = FreeBlocks(10)
+    blocks.take(2, 4)
+    blocks.take(6, 7)
+    assert blocks.lengths == {0: 2, 4: 2, 7: 3}
+    assert blocks.best_fit(2) == 0
+    assert blocks.best_fit(3) == 7
+    # the run of 3 from node 7 has only 2 from node 8
+    assert blocks.best_fit(3, align=2) is None
+    assert blocks.best_fit(4) is None
+    assert blocks.largest() == 3
+    copy = blocks.copy()
+    blocks.give(6, 7)
+    assert blocks.lengths == {0: 2, 4: 6}
+    assert copy.lengths == {0: 2, 4: 2, 7: 3}
+    blocks.give(2, 4)
+    assert blocks.lengths == {0: 10}
+    assert blocks.by_size == [(10, 0)]
+
+
+@pytest.mark.parametrize("policy", POLICIES)
+def test_allocate_release_cycles(policy):
+    rng = np.random.RandomState(0)
+    # not a whole number of switches
+    cluster = NodeCluster("Cluster", 100, 4, policy=policy, nodes_per_switch=8)
+    running = {}
+    for job_id in range(2000):
+        if running and (rng.rand() < 0.5 or cluster.free_node == 0):
+            nodes = running.pop(rng.choice(list(running)))
+            cluster.release(nodes)
+        else:
+            procs = rng.randint(0, 4 * min(cluster.free_node, 30) + 1)
+            nodes = cluster.allocate(job_id, procs)
+            assert len(nodes) == -(-procs // 4)
+            running[job_id] = nodes
+        check_consistent(cluster)
+    state = cluster.snapshot()
+    for nodes in running.values():
+        cluster.release(nodes)
+    assert cluster.is_idle()
+    check_consistent(cluster)
+    cluster.restore(state)
+    check_consistent(cluster)
+
+
+def test_fragmentation():
+    cluster = make_node_cluster(FREE_MAP, "first_fit")
+    fragmentation = cluster.fragmentation()
+    assert fragmentation == {"free_nodes": 10, "free_blocks": 3, "largest_free_block": 7,
+                             "external": pytest.approx(0.3), "job_runs": 1.0, "job_switches": 4.0}
+    # nodes 1 to 7 and 9: two runs on three switches
+    cluster.allocate(7, 8)
+    fragmentation = cluster.fragmentation()
+    assert fragmentation == {"free_nodes": 2, "free_blocks": 2, "largest_free_block": 1,
+                             "external": pytest.approx(0.5), "job_runs": 1.5, "job_switches": 3.5}
+    cluster.reset()
+    assert cluster.fragmentation() == {"free_nodes": 16, "free_blocks": 1, "largest_free_block": 16,
+                                       "external": 0.0, "job_runs": 0.0, "job_switches": 0.0}
+
+
+@pytest.mark.parametrize("backfil", [False, True])
+def test_same_schedule(backfil):
+    # only which nodes the jobs get depends on the cluster model: the heuristics schedule the same
+    pytest.importorskip("gym")
+    from HPCSimPickJobs import HPCEnv
+
+    schedules = {}
+    for cluster, policy in [("simple", "first_fit")] + [("node", policy) for policy in POLICIES]:
+        random.seed(0)
+        env = HPCEnv(backfil=backfil, baseline_cache=False, cluster=cluster, cluster_policy=policy)
+        env.seed(0)
+        env.my_init(workload_file=WORKLOAD)
+        env.reset()
+        schedules[cluster, policy] = [env.schedule_curr_sequence_reset(score_fn)
+                                      for score_fn in [env.fcfs_score, env.sjf_score, env.f1_score]]
+    for key, schedule in schedules.items():
+        assert schedule == schedules["simple", "first_fit"], key
@@ -0,0 +1,117 @@
+"""
+The wait queue of HPCEnv (JobQueue) and its observation against the old observation, which sorted a list of the
+waiting jobs in place, and HPCEnv.snapshot/restore.
+"""
+import os
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("gym")
+
+from HPCSimPickJobs import HPCEnv, JobQueue, shuffle_draws
+
+WORKLOAD = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "lublin_256.swf")
+
+
+def test_shuffle_draws():
+    for n in [0, 1, 2, 5, 128, 300]:
+        random.seed(n)
+        random.shuffle(list(range(n)))
+        expected = random.getstate()
+        random.seed(n)
+        shuffle_draws(n)
+        assert random.getstate() == expected
+
+
+def test_observation_orders():
+    rng = np.random.RandomState(0)
+    num_jobs, offset, count = 600, 1000, 8
+    # few distinct values, for many ties. As the ranks of build_job_features, the SJF and smallest keys include the
+    # submit time, and the smallest key the request time too.
+    submit_time = rng.randint(0, 20, size=num_jobs)
+    request_time = rng.randint(0, 4, size=num_jobs)
+    processors = rng.randint(0, 4, size=num_jobs)
+    keys = {"fcfs": submit_time,
+            "sjf": request_time * 100 + submit_time,
+            "smallest": processors * 10000 + submit_time * 100 + request_time}
+    jobs = [SimpleNamespace(job_id=i + 1, trace_idx=i + offset, submit_time=int(submit_time[i]))
+            for i in range(num_jobs)]
+
+    def key(name):
+        return lambda job: keys[name][job.trace_idx - offset]
+
+    queue = JobQueue()
+    queue.observe_by(keys, offset)
+    old_queue = []
+    arrived = 0
+    while arrived < num_jobs or old_queue:
+        if arrived < num_jobs and (not old_queue or rng.rand() < 0.55):
+            queue.append(jobs[arrived])
+            old_queue.append(jobs[arrived])
+            arrived += 1
+        else:
+            job = old_queue[rng.randint(len(old_queue))]
+            queue.remove(job)
+            old_queue.remove(job)
+        if rng.rand() < 0.05:
+            queue = queue.copy()
+        if rng.rand() < 0.02:
+            queue.observe_by(keys, offset)
+
+        old_queue.sort(key=key("fcfs"))
+        if len(old_queue) <= count:
+            assert queue.first("fcfs", count) == old_queue
+        else:
+            old_queue.sort(key=key("sjf"))
+            assert queue.first("sjf", count) == old_queue[:count]
+            old_queue.sort(key=key("smallest"))
+            assert queue.first("smallest", count) == old_queue[:count]
+            queue.sort_smallest_first()
+
+
+def rollout(env, rng, actions=None):
+    # plays the episode to its end, with random valid actions or the given ones; returns the actions, observations
+    # and masks of each step, and the final result of step
+    taken, observations, masks = [], [], []
+    obs = env.build_observation()
+    while True:
+        observations.append(obs)
+        masks.append(env.action_mask.copy())
+        a = rng.choice(np.flatnonzero(env.action_mask)) if actions is None else actions[len(taken)]
+        taken.append(a)
+        result = env.step(a)
+        if result[2]:
+            return taken, observations, masks, result[1:6]
+        obs = result[0]
+
+
+@pytest.mark.parametrize("cluster", ["simple", "node"])
+@pytest.mark.parametrize("backfil", [False, True])
+def test_snapshot_restore(cluster, backfil):
+    random.seed(0)
+    env = HPCEnv(backfil=backfil, baseline_cache=False, cluster=cluster)
+    env.seed(0)
+    env.my_init(workload_file=WORKLOAD)
+    env.reset()
+    rng = np.random.RandomState(0)
+    for _ in range(30):
+        env.step(rng.choice(np.flatnonzero(env.action_mask)))
+
+    state = env.snapshot()
+    obs, mask = env.build_observation(), env.action_mask.copy()
+    actions, observations, masks, result = rollout(env, rng)
+    assert len(actions) > 1
+
+    env.restore(state)
+    assert np.array_equal(env.build_observation(), obs)
+    assert np.array_equal(env.action_mask, mask)
+    _, replayed_observations, replayed_masks, replayed_result = rollout(env, rng, actions)
+    assert replayed_result == result
+    assert len(replayed_observations) == len(observations)
+    for replayed, expected in zip(replayed_observations, observations):
+        assert np.array_equal(replayed, expected)
+    for replayed, expected in zip(replayed_masks, masks):
+        assert np.array_equal(replayed, expected)
@@ -0,0 +1,126 @@
+"""
+The bulk SWF parser (parse_swf_lines, build_cache) against parsing every line with Job, on the bundled traces and
+on lines that take its slower paths.
+"""
+import os
+import glob
+import shutil
+
+import numpy as np
+import pytest
+
+from job import Job, SWF_FIELDS, jobs_to_columns, new_stats, parse_swf_lines, build_cache
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def is_swf(path):
+    # the bundled traces, among the caches and baselines next to them, by their header
+    with open(path, "rb") as fp:
+        return fp.read(1) == b";"
+
+
+TRACES = sorted(path for path in glob.glob(os.path.join(DATA, "*")) if os.path.isfile(path) and is_swf(path))
+
+
+def data_lines(path):
+    with open(path) as fp:
+        return [line for line in fp if not line.startswith(";")]
+
+
+def set_field(line, name, value):
+    fields = line.split()
+    fields[SWF_FIELDS.index(name)] = value
+    return " ".join(fields) + "\n"
+
+
+def assert_same_columns(columns, expected):
+    for name in SWF_FIELDS:
+        assert columns[name].dtype == expected[name].dtype, name
+        assert np.array_equal(columns[name], expected[name]), name
+
+
+def workload_by_line(lines):
+    # the legal jobs sorted by job id and the trace statistics, as Workloads used to find them line by line
+    stats = new_stats()
+    jobs = []
+    for line in lines:
+        j = Job(line)
+        stats["max_exec_time"] = max(stats["max_exec_time"], j.run_time)
+        stats["min_exec_time"] = min(stats["min_exec_time"], j.run_time)
+        stats["max_requested_memory"] = max(stats["max_requested_memory"], j.request_memory)
+        stats["max_user_id"] = max(stats["max_user_id"], j.user_id)
+        stats["max_group_id"] = max(stats["max_group_id"], j.group_id)
+        stats["max_executable_number"] = max(stats["max_executable_number"], j.executable_number)
+        if j.run_time < 0:
+            j.run_time = 10
+        if j.run_time > 0:
+            jobs.append(j)
+            stats["max"] = max(stats["max"], j.request_number_of_processors)
+    return jobs_to_columns(sorted(jobs, key=lambda job: job.job_id)), stats
+
+
+@pytest.mark.parametrize("path", TRACES, ids=os.path.basename)
+def test_parse_swf_lines_bundled_traces(path):
+    lines = data_lines(path)
+    assert_same_columns(parse_swf_lines(lines), jobs_to_columns([Job(line) for line in lines]))
+
+
+@pytest.mark.parametrize("path", TRACES, ids=os.path.basename)
+def test_build_cache_bundled_traces(path, tmp_path):
+    trace = str(tmp_path / os.path.basename(path))
+    shutil.copy(path, trace)
+    # small chunks, so that the columns of many of them are appended and sorted
+    columns, meta = build_cache(trace, chunk_size=1000)
+    expected, stats = workload_by_line(data_lines(path))
+    assert_same_columns(columns, expected)
+    for name in stats:
+        if name not in ["max_nodes", "max_procs"]:  # from the header
+            assert meta[name] == stats[name], name
+
+
+def sample_lines():
+    return data_lines(TRACES[0])[:200]
+
+
+def test_float_field():
+    lines = sample_lines()
+    for k in range(0, len(lines), 3):
+        lines[k] = set_field(lines[k], "average_cpu_time_used", "{}.25".format(k))
+    columns = parse_swf_lines(lines)
+    assert_same_columns(columns, jobs_to_columns([Job(line) for line in lines]))
+    assert columns["average_cpu_time_used"][3] == 3.25
+
+
+def test_partition_not_an_integer():
+    lines = sample_lines()
+    lines[5] = set_field(lines[5], "partition_number", "batch")
+    lines[7] = set_field(lines[7], "partition_number", "2.0")
+    lines[9] = set_field(lines[9], "average_cpu_time_used", "1.5")
+    columns = parse_swf_lines(lines)
+    assert_same_columns(columns, jobs_to_columns([Job(line) for line in lines]))
+    assert columns["partition_number"][5] == 0 and columns["partition_number"][7] == 0
+
+
+def test_extra_fields():
+    lines = sample_lines()
+    lines[10] = lines[10].rstrip("\n") + " 42 43\n"
+    lines[11] = set_field(lines[11], "average_cpu_time_used", "0.5")
+    assert_same_columns(parse_swf_lines(lines), jobs_to_columns([Job(line) for line in lines]))
+
+
+@pytest.mark.parametrize("name, value", [("run_time", "12.5"), ("submit_time", "1e3"), ("user_id", "x")])
+def test_invalid_integer_raises(name, value):
+    lines = sample_lines()
+    lines[20] = set_field(lines[20], name, value)
+    with pytest.raises(ValueError):
+        Job(lines[20])
+    with pytest.raises(ValueError):
+        parse_swf_lines(lines)
+
+
+def test_missing_fields_raise():
+    lines = sample_lines()
+    lines[30] = " ".join(lines[30].split()[:10]) + "\n"
+    with pytest.raises(IndexError):
+        parse_swf_lines(lines)
@@ -0,0 +1,78 @@
+"""
+A smoke run of the actor plumbing of the pipelined mode of ppo (vec_env.actor_loop, get_trajectory, stop_actors),
+with a random policy instead of TensorFlow.
+"""
+import os
+import queue
+import multiprocessing
+
+import numpy as np
+import pytest
+
+pytest.importorskip("gym")
+
+import vec_env
+from HPCSimPickJobs import MAX_QUEUE_SIZE, JOB_FEATURES
+
+WORKLOAD = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "lublin_256.swf")
+
+
+def random_actor(actor_id, param_queue, traj_queue):
+    venv = vec_env.VecHPCEnv(WORKLOAD, 2, seed=2 * actor_id)
+    rng = np.random.RandomState(actor_id)
+    version = -1
+
+    def poll_params(block):
+        nonlocal version
+        try:
+            version = param_queue.get(timeout=None if block else 0)
+        except queue.Empty:
+            pass
+        return version
+
+    def policy(obs, masks):
+        actions = [rng.choice(np.flatnonzero(mask)) for mask in masks]
+        return actions, np.zeros(len(masks)), np.zeros(len(masks))
+
+    vec_env.actor_loop(venv, policy, poll_params, traj_queue)
+
+
+def dead_actor(actor_id, param_queue, traj_queue):
+    pass
+
+
+def start_actors(target, num_actors):
+    ctx = multiprocessing.get_context("spawn")
+    traj_queue = ctx.Queue(maxsize=4)
+    param_queues = [ctx.Queue() for _ in range(num_actors)]
+    actors = [ctx.Process(target=target, args=(i, param_queues[i], traj_queue), daemon=True)
+              for i in range(num_actors)]
+    for actor in actors:
+        actor.start()
+    return actors, param_queues, traj_queue
+
+
+def test_actor_trajectories():
+    actors, param_queues, traj_queue = start_actors(random_actor, 2)
+    try:
+        for param_queue in param_queues:
+            param_queue.put(0)
+        for _ in range(6):
+            version, steps, last_r, stats = vec_env.get_trajectory(traj_queue, actors, timeout=60)
+            assert version == 0
+            assert len(steps) == stats[1] > 0
+            obs, act, mask, rew, val, logp = steps[0]
+            assert mask[act] == 1 and rew == 0
+            assert obs.shape == (MAX_QUEUE_SIZE * JOB_FEATURES,)
+    finally:
+        vec_env.stop_actors(actors, param_queues)
+    assert not any(actor.is_alive() for actor in actors)
+
+
+def test_dead_actor():
+    actors, param_queues, traj_queue = start_actors(dead_actor, 1)
+    try:
+        with pytest.raises(RuntimeError):
+            vec_env.get_trajectory(traj_queue, actors, timeout=0.1)
+    finally:
+        vec_env.stop_actors(actors, param_queues)
@@ -0,0 +1,300 @@
+import queue
+import traceback
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from HPCSimPickJobs import HPCEnv, MAX_QUEUE_SIZE
+
+# commands written by SubprocVecHPCEnv for each environment of a worker
+CMD_NONE, CMD_RESET, CMD_STEP, CMD_CLOSE = 0, 1, 2, 3
+
+
+class VecHPCEnv:
+    """
+    num_envs independent HPCEnv, each with its own seed (seed + i), stepped in lockstep so that the actions of all
+    of them are picked with one batched forward pass of the policy.
+    self.obs and self.masks hold the current observation and action mask of every environment, one row each.
+    reset and step take the ids of the environments to act on (all of them by default); the other rows are left
+    untouched, and a finished environment keeps its last observation until it is reset.
+    """
+    def __init__(self, workload_file, num_envs, seed=0, **env_kwargs):
+        self.num_envs = num_envs
+        self.envs = []
+        for i in range(num_envs):
+            env = HPCEnv(**env_kwargs)
+            env.seed(seed + i)
+            env.my_init(workload_file=workload_file)
+            self.envs.append(env)
+
+        self.observation_space = self.envs[0].observation_space
+        self.action_space = self.envs[0].action_space
+        self.obs = np.zeros((num_envs,) + self.observation_space.shape, dtype=np.float32)
+        self.masks = np.zeros((num_envs, MAX_QUEUE_SIZE), dtype=np.float32)
+
+    def reset(self, env_ids=None):
+        if env_ids is None:
+            env_ids = range(self.num_envs)
+        for i in env_ids:
+            o, co, mask = self.envs[i].reset()
+            self.obs[i] = o
+            self.masks[i] = mask
+        return self.obs, self.masks
+
+    def step(self, actions, env_ids=None):
+        """
+        Step environment env_ids[k] with actions[k].
+        Returns the observations and masks of all the environments, then the reward, done flag and
+        (reward against the best heuristic, sjf score, f1 score) of each stepped environment, as in HPCEnv.step.
+        """
+        if env_ids is None:
+            env_ids = range(self.num_envs)
+        num = len(env_ids)
+        rews, dones = np.zeros(num), np.zeros(num, dtype=bool)
+        infos = np.zeros((num, 3))
+        for k, i in enumerate(env_ids):
+            o, r, d, r2, sjf, f1, mask = self.envs[i].step(actions[k])
+            if not d:
+                self.obs[i] = o
+                self.masks[i] = mask
+            rews[k], dones[k], infos[k] = r, d, (r2, sjf, f1)
+        return self.obs, self.masks, rews, dones, infos
+
+    def close(self):
+        # nothing to release, the environments are simulated in this process
+        pass
+
+
+def shared_buffers(num_envs, obs_dim):
+    # ctypes arrays in shared memory: created once, then only read and written in place by the learner and workers
+    return dict(obs=(RawArray('f', num_envs * obs_dim), np.float32, (num_envs, obs_dim)),
+                masks=(RawArray('f', num_envs * MAX_QUEUE_SIZE), np.float32, (num_envs, MAX_QUEUE_SIZE)),
+                actions=(RawArray('l', num_envs), np.int_, (num_envs,)),
+                rews=(RawArray('d', num_envs), np.float64, (num_envs,)),
+                dones=(RawArray('b', num_envs), np.int8, (num_envs,)),
+                infos=(RawArray('d', num_envs * 3), np.float64, (num_envs, 3)),
+                cmds=(RawArray('b', num_envs), np.int8, (num_envs,)),
+                errors=(RawArray('b', num_envs), np.int8, (num_envs,)))
+
+
+def buffer_views(buffers):
+    return {name: np.frombuffer(raw, dtype=dtype).reshape(shape) for name, (raw, dtype, shape) in buffers.items()}
+
+
+def env_worker(env_ids, workload_file, seed, env_kwargs, buffers, start, done):
+    views = buffer_views(buffers)
+    obs, masks, cmds = views["obs"], views["masks"], views["cmds"]
+    try:
+        envs = {}
+        for i in env_ids:
+            env = HPCEnv(**env_kwargs)
+            env.seed(seed + i)
+            env.my_init(workload_file=workload_file)
+            envs[i] = env
+    except Exception:
+        traceback.print_exc()
+        views["errors"][env_ids] = 1
+    done.release()
+
+    while True:
+        start.acquire()
+        try:
+            for i in env_ids:
+                if cmds[i] == CMD_CLOSE:
+                    return
+                if cmds[i] == CMD_RESET:
+                    o, co, mask = envs[i].reset()
+                    obs[i] = o
+                    masks[i] = mask
+                elif cmds[i] == CMD_STEP:
+                    o, r, d, r2, sjf, f1, mask = envs[i].step(int(views["actions"][i]))
+                    if not d:
+                        obs[i] = o
+                        masks[i] = mask
+                    views["rews"][i], views["dones"][i], views["infos"][i] = r, d, (r2, sjf, f1)
+                cmds[i] = CMD_NONE
+        except Exception:
+            traceback.print_exc()
+            views["errors"][env_ids] = 1
+        done.release()
+
+
+class SubprocVecHPCEnv:
+    """
+    Same as VecHPCEnv, but the environments run in num_workers worker processes (environment i in worker
+    i % num_workers), so that the simulation of all of them uses all the cores while the learner runs the policy.
+    Observations, masks, actions and results are exchanged through arrays in shared memory, and each step is only
+    synchronized with one pair of semaphores per worker: nothing is pickled once the workers are started.
+    Environment i is seeded with seed + i as in VecHPCEnv, so both give the same trajectories.
+    """
+    def __init__(self, workload_file, num_envs, seed=0, num_workers=None, **env_kwargs):
+        self.num_envs = num_envs
+        num_workers = min(num_envs, num_workers or multiprocessing.cpu_count())
+        spaces_env = HPCEnv(**env_kwargs)
+        self.observation_space = spaces_env.observation_space
+        self.action_space = spaces_env.action_space
+
+        buffers = shared_buffers(num_envs, self.observation_space.shape[0])
+        views = buffer_views(buffers)
+        self.obs, self.masks = views["obs"], views["masks"]
+        self.actions, self.rews, self.dones, self.infos = views["actions"], views["rews"], views["dones"], views["infos"]
+        self.cmds, self.errors = views["cmds"], views["errors"]
+
+        self.env_worker = [i % num_workers for i in range(num_envs)]
+        self.workers, self.starts, self.done_events = [], [], []
+        for w in range(num_workers):
+            start, done = multiprocessing.Semaphore(0), multiprocessing.Semaphore(0)
+            worker = multiprocessing.Process(target=env_worker, daemon=True,
+                                             args=(list(range(w, num_envs, num_workers)), workload_file, seed,
+                                                   env_kwargs, buffers, start, done))
+            worker.start()
+            self.workers.append(worker)
+            self.starts.append(start)
+            self.done_events.append(done)
+        self.wait(range(num_workers))
+
+    def wait(self, workers):
+        for w in workers:
+            while not self.done_events[w].acquire(timeout=1.0):
+                if not self.workers[w].is_alive():
+                    raise RuntimeError("environment worker %d died" % w)
+        if self.errors.any():
+            raise RuntimeError("environment worker failed, see its traceback above")
+
+    def run(self, cmd, env_ids):
+        self.cmds[env_ids] = cmd
+        workers = sorted(set(self.env_worker[i] for i in env_ids))
+        for w in workers:
+            self.starts[w].release()
+        self.wait(workers)
+
+    def reset(self, env_ids=None):
+        if env_ids is None:
+            env_ids = range(self.num_envs)
+        self.run(CMD_RESET, env_ids)
+        return self.obs, self.masks
+
+    def step(self, actions, env_ids=None):
+        # see VecHPCEnv.step
+        if env_ids is None:
+            env_ids = range(self.num_envs)
+        self.actions[env_ids] = actions
+        self.run(CMD_STEP, env_ids)
+        return self.obs, self.masks, self.rews[env_ids], self.dones[env_ids].astype(bool), self.infos[env_ids]
+
+    def close(self):
+        self.cmds[:] = CMD_CLOSE
+        for start in self.starts:
+            start.release()
+        for worker in self.workers:
+            worker.join()
+
+
+def actor_loop(venv, policy, poll_params, traj_queue):
+    """
+    The loop of an actor of the pipelined mode of ppo: keeps stepping the environments of venv with the actions,
+    values and logps of policy(obs, masks), and puts every finished trajectory on traj_queue, blocking while it is
+    full. poll_params(block) loads the latest parameters the learner sent, if any (waiting for the first ones if
+    block), and returns the version of the policy; it is called between steps, so a trajectory may come from a
+    policy a few versions old. Each trajectory is sent with the version it started with, its steps (obs, act, mask,
+    rew, val, logp as in PPOBuffer.store), its last reward and its stats (return, length, reward against the best
+    heuristic, sjf and f1 scores). Never returns: the learner stops the actor processes, see stop_actors.
+    """
+    num_envs = venv.num_envs
+    version = poll_params(True)
+    obs, masks = venv.reset()
+    trajs = [[] for _ in range(num_envs)]
+    started = [version] * num_envs
+    r = np.zeros(num_envs)
+    ep_ret, ep_len, show_ret, sjf, f1 = [np.zeros(num_envs) for _ in range(5)]
+    while True:
+        a, v_t, logp_t = policy(obs, masks)
+        for i in range(num_envs):
+            trajs[i].append((obs[i].copy(), a[i], masks[i].copy(), r[i], v_t[i], logp_t[i]))
+
+        obs, masks, rews, dones, infos = venv.step(a)
+        r[:] = rews
+        ep_ret += rews
+        ep_len += 1
+        show_ret += infos[:, 0]
+        sjf += infos[:, 1]
+        f1 += infos[:, 2]
+
+        for i in np.flatnonzero(dones):
+            traj_queue.put((started[i], trajs[i], r[i], (ep_ret[i], ep_len[i], show_ret[i], sjf[i], f1[i])))
+            trajs[i] = []
+            r[i], ep_ret[i], ep_len[i], show_ret[i], sjf[i], f1[i] = 0, 0, 0, 0, 0, 0
+            obs, masks = venv.reset([i])
+            started[i] = version
+        version = poll_params(False)
+
+
+def get_trajectory(traj_queue, actors, timeout=1.0):
+    # the next trajectory of the actor processes, checking that they are all alive while there is none
+    while True:
+        try:
+            return traj_queue.get(timeout=timeout)
+        except queue.Empty:
+            for i, actor in enumerate(actors):
+                if not actor.is_alive():
+                    raise RuntimeError("actor %d died (exit code %s)" % (i, actor.exitcode))
+
+
+def stop_actors(actors, queues=()):
+    # terminate the actor processes and wait for them. What is left in the queues they read is dropped, so that
+    # this process does not wait at exit to flush it to them.
+    for q in queues:
+        q.cancel_join_thread()
+    for actor in actors:
+        actor.terminate()
+    for actor in actors:
+        actor.join()
+
+
+def test_envs(workload_file, num_envs, num_jobs, seed=0, **env_kwargs):
+    """
+    One HPCEnv reset on each of the num_envs test sequences of num_jobs jobs that num_envs successive
+    reset_for_test(num_jobs, ...) of a single environment seeded with seed go through, so that evaluating them
+    together gives the results of evaluating them one after the other.
+    """
+    envs = []
+    for i in range(num_envs):
+        env = HPCEnv(**env_kwargs)
+        env.my_init(workload_file=workload_file)
+        env.seed(seed)
+        envs.append(env)
+    # the first environment draws the start indices, as it would in a sequential evaluation
+    starts = []
+    for i in range(num_envs):
+        envs[0].reset_for_test(num_jobs, 0)
+        starts.append(envs[0].start)
+    for env, start in zip(envs, starts):
+        env.reset_for_sequence(start, num_jobs)
+    return envs
+
+
+def run_test_sequences(envs, get_actions):
+    """
+    Schedule the current sequence of every environment to its end with step_for_test, all of them in lockstep:
+    every round, the observations and masks of the sequences not done yet are stacked and their actions come from
+    one call of get_actions(obs, masks), so the evaluation takes as many forward passes as the longest sequence
+    has decisions. Returns the total reward of each sequence and the (action, number of valid actions, whether it
+    was a skip) of each of its decisions.
+    """
+    rewards = np.zeros(len(envs))
+    decisions = [[] for _ in envs]
+    obs = [env.build_observation() for env in envs]
+    masks = [env.action_mask for env in envs]
+    running = list(range(len(envs)))
+    while running:
+        actions = get_actions(np.stack([obs[i] for i in running]), np.stack([masks[i] for i in running]))
+        still_running = []
+        for i, a in zip(running, actions):
+            decisions[i].append((int(a), int(masks[i].sum()), envs[i].visible_job(a) is None))
+            obs[i], r, d, masks[i] = envs[i].step_for_test(a)
+            rewards[i] += r
+            if not d:
+                still_running.append(i)
+        running = still_running
+    return rewards, decisions